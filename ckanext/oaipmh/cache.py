@@ -0,0 +1,136 @@
+'''Caches for the OAI-PMH server.
+'''
+import cPickle as pickle
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    '''A bounded, thread-safe least recently used cache.
+
+    If `spill_dir` is given, entries evicted from memory are written there
+    and read back on a later miss, so that the cache can grow beyond memory
+    and survive restarts. Keys must be picklable and their repr stable.
+    '''
+    def __init__(self, size, spill_dir=None):
+        self.size = size
+        self.spill_dir = spill_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if spill_dir and not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def configure(self, size, spill_dir=None):
+        '''Change the size and the spill directory of the cache. Entries
+        beyond the new size are dropped from memory.
+        '''
+        if spill_dir and not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+        with self._lock:
+            self.size = size
+            self.spill_dir = spill_dir
+            while self._entries and len(self._entries) > max(size, 0):
+                self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(repr(key)).hexdigest())
+
+    def _spill(self, key, value):
+        fd, temp_path = tempfile.mkstemp(dir=self.spill_dir)
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                pickle.dump((key, value), temp_file, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, self._path(key))
+        except (IOError, OSError, pickle.PicklingError) as e:
+            log.warning('Unable to spill cache entry to %s: %s', self.spill_dir, e)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _unspill(self, key):
+        try:
+            with open(self._path(key), 'rb') as spill_file:
+                spilled_key, value = pickle.load(spill_file)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        # Guard against hash collisions
+        return value if spilled_key == key else None
+
+    def get(self, key, default=None):
+        '''Return the cached value for key, or `default` if there is none.
+        '''
+        with self._lock:
+            if key in self._entries:
+                value = self._entries.pop(key)
+                self._entries[key] = value
+                return value
+        if not self.spill_dir:
+            return default
+        value = self._unspill(key)
+        if value is None:
+            return default
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        '''Cache a value, evicting the least recently used entries if the
+        cache is full.
+        '''
+        if self.size <= 0:
+            return
+        evicted = []
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                evicted.append(self._entries.popitem(last=False))
+        if self.spill_dir:
+            for evicted_key, evicted_value in evicted:
+                self._spill(evicted_key, evicted_value)
+
+    def clear(self):
+        '''Remove all entries from memory. Spilled entries are kept.
+        '''
+        with self._lock:
+            self._entries.clear()
+
+
+class ExpiringValue(object):
+    '''A single cached value, which is made again when it is older than
+    `ttl` seconds, has been cleared or was made for another version.
+    '''
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._value = None
+        self._version = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def get(self, factory, version=None):
+        '''Return the cached value, or the value returned by `factory` if
+        the cached one has expired or was made for another `version`.
+        '''
+        with self._lock:
+            if time.time() < self._expires and self._version == version:
+                return self._value
+        value = factory()
+        with self._lock:
+            self._value = value
+            self._version = version
+            self._expires = time.time() + self.ttl
+        return value
+
+    def clear(self):
+        '''Expire the cached value.
+        '''
+        with self._lock:
+            self._expires = 0
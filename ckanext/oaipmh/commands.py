@@ -0,0 +1,61 @@
+'''Paster commands of the OAI-PMH server.
+'''
+import sys
+
+from ckan.lib.cli import CkanCommand
+
+
+class OAIPMHCommand(CkanCommand):
+    '''Maintain the OAI-PMH server
+
+    Usage:
+
+      oaipmh rebuild
+        - Render the records of all datasets to the oaipmh_record table again
+          and index the datasets of all sets
+
+      oaipmh snapshot
+        - Write the pages of complete ListRecords lists to the directory set
+          by ckanext.oaipmh.snapshot_dir
+    '''
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 1
+    min_args = 1
+
+    def command(self):
+        self._load_config()
+
+        cmd = self.args[0]
+        if cmd == 'rebuild':
+            self.rebuild()
+        elif cmd == 'snapshot':
+            self.snapshot()
+        else:
+            print 'Command %s not recognized' % cmd
+            sys.exit(1)
+
+    def rebuild(self):
+        from ckan import model
+        from ckanext.oaipmh import model as oaipmh_model
+        from ckanext.oaipmh import records
+        from ckanext.oaipmh import sets
+
+        oaipmh_model.setup()
+        count = records.rebuild()
+        sets.rebuild()
+        model.repo.commit()
+        print 'Rebuilt %d records' % count
+
+    def snapshot(self):
+        from ckanext.oaipmh import controller
+        from ckanext.oaipmh import snapshot
+
+        directory = snapshot.get_snapshot_dir()
+        if not directory:
+            print 'Set ckanext.oaipmh.snapshot_dir to write snapshots'
+            sys.exit(1)
+        server = controller.get_server()
+        prefixes = [prefix for prefix, schema, namespace in controller._ckan_server.listMetadataFormats()]
+        manifest = snapshot.write_snapshot(server, directory, prefixes)
+        print 'Wrote snapshot %s' % manifest['id']
@@ -0,0 +1,73 @@
+'''HTTP compression of OAI-PMH responses.
+
+Responses are compressed while they are streamed, one chunk at a time, so a
+compressed response is never held in memory as a whole.
+'''
+import zlib
+
+# Content codings in the order of preference, with their zlib window bits
+ENCODINGS = (('gzip', 16 + zlib.MAX_WBITS),
+             ('deflate', zlib.MAX_WBITS))
+
+
+def _parse_accept_encoding(accept_encoding):
+    '''Parse an Accept-Encoding header.
+
+    :returns: dictionary of quality values by content coding
+    '''
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+
+def choose_encoding(accept_encoding):
+    '''Choose the content coding of a response.
+
+    :param accept_encoding: value of the Accept-Encoding header, or None
+    :returns: 'gzip', 'deflate' or None for an uncompressed response
+    '''
+    if not accept_encoding:
+        return None
+    qualities = _parse_accept_encoding(accept_encoding)
+    best = None
+    for encoding, wbits in ENCODINGS:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = encoding, quality
+    return best[0] if best else None
+
+
+def compress(body, encoding, level=6):
+    '''Generate the compressed chunks of a response body.
+
+    :param body: string or iterable of strings
+    :param encoding: 'gzip' or 'deflate'
+    :param level: zlib compression level
+    '''
+    if isinstance(body, basestring):
+        body = [body]
+    compressor = zlib.compressobj(level, zlib.DEFLATED, dict(ENCODINGS)[encoding])
+    try:
+        for chunk in body:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
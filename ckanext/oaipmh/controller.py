@@ -1,17 +1,231 @@
 '''Serving controller interface for OAI-PMH
 '''
+import calendar
+import hashlib
 import logging
+import re
+import threading
+from datetime import datetime
+from email.utils import formatdate, mktime_tz, parsedate_tz
 
 import oaipmh.metadata as oaimd
 import oaipmh.server as oaisrv
-from pylons import request, response
+from oaipmh.datestamp import datestamp_to_datetime, datetime_to_datestamp
+from oaipmh.error import DatestampError, ErrorBase
+from paste.deploy.converters import asint
+from pylons import config, request, response
 
 from ckan.lib.base import BaseController, render
+from cache import LRUCache
+import compression
+from model import get_change_count
 from oaipmh_server import CKANServer
+import records
+import snapshot
+from singleflight import SingleFlight
+from streaming import StreamingBatchingServer
 from rdftools import rdf_reader, dcat2rdf_writer
 
 log = logging.getLogger(__name__)
 
+_server = None
+_ckan_server = None
+_server_lock = threading.Lock()
+
+BATCH_SIZE_OPTION = 'ckanext.oaipmh.batch_size.'
+
+# Verbs whose responses change only when the datestamps of records change
+CONDITIONAL_VERBS = ('Identify', 'GetRecord', 'ListIdentifiers', 'ListRecords')
+
+# Verbs whose responses are kept in the page cache
+CACHED_VERBS = ('GetRecord', 'ListIdentifiers', 'ListRecords')
+
+RESPONSE_DATE = re.compile(r'<responseDate>[^<]*</responseDate>')
+
+# Responses by request parameters, with the change count when they were made
+page_cache = LRUCache(50)
+
+# Largest response in bytes kept in the page cache
+page_cache_max_bytes = 1024 * 1024
+
+# Responses of the `CACHED_VERBS` being made, shared by concurrent identical
+# requests of this process
+request_flights = SingleFlight()
+
+
+def configure(config):
+    '''Read the options of the controller, size the page cache and set the
+    time requests wait for the responses of identical requests. Called by
+    the plugin when CKAN is configured.
+    '''
+    global page_cache_max_bytes
+    page_cache.configure(asint(config.get('ckanext.oaipmh.page_cache_size', 50)),
+                         config.get('ckanext.oaipmh.page_cache_dir', None))
+    page_cache_max_bytes = asint(config.get('ckanext.oaipmh.page_cache_max_bytes', 1024 * 1024))
+    request_flights.timeout = asint(config.get('ckanext.oaipmh.coalesce_timeout', 30))
+
+
+def _get_batch_sizes():
+    '''Read the page sizes of single verbs and metadata prefixes from options
+    like ckanext.oaipmh.batch_size.ListRecords.rdf = 20 or
+    ckanext.oaipmh.batch_size.ListIdentifiers = 1000.
+
+    :returns: dictionary of page sizes by (verb, metadataPrefix), where
+        metadataPrefix is None for options of a whole verb
+    '''
+    batch_sizes = {}
+    for key, value in config.items():
+        if key.startswith(BATCH_SIZE_OPTION):
+            verb, _, prefix = key[len(BATCH_SIZE_OPTION):].partition('.')
+            batch_sizes[(verb, prefix or None)] = asint(value)
+    return batch_sizes
+
+
+def get_server():
+    '''Return the batching OAI-PMH server of this process. The server and its
+    metadata registry are stateless, so they are created once and shared by
+    all requests and threads.
+    '''
+    global _server, _ckan_server
+    if _server is None:
+        with _server_lock:
+            if _server is None:
+                metadata_registry = oaimd.MetadataRegistry()
+                metadata_registry.registerReader('oai_dc', oaimd.oai_dc_reader)
+                metadata_registry.registerWriter('oai_dc', oaisrv.oai_dc_writer)
+                metadata_registry.registerReader('rdf', rdf_reader)
+                metadata_registry.registerWriter('rdf', dcat2rdf_writer)
+                keyset = config.get('ckanext.oaipmh.resumption_tokens', 'keyset') != 'offset'
+                _ckan_server = records.RecordServer() if records.enabled() else CKANServer()
+                _server = StreamingBatchingServer(_ckan_server,
+                                                  metadata_registry=metadata_registry,
+                                                  resumption_batch_size=asint(config.get('ckanext.oaipmh.batch_size', 100)),
+                                                  keyset=keyset,
+                                                  batch_sizes=_get_batch_sizes())
+    return _server
+
+
+def _get_list_arguments(params):
+    '''Get the set, from and until arguments of a request, also from its
+    resumption token.
+
+    :returns: tuple of set, from and until
+    '''
+    if 'resumptionToken' in params:
+        kw, cursor = oaisrv.decodeResumptionToken(params['resumptionToken'])
+        return kw.get('set'), kw.get('from_'), kw.get('until')
+    if params.get('verb') not in ('ListIdentifiers', 'ListRecords'):
+        return None, None, None
+    from_ = params.get('from')
+    until = params.get('until')
+    return (params.get('set'),
+            datestamp_to_datetime(from_) if from_ else None,
+            datestamp_to_datetime(until, inclusive=True) if until else None)
+
+
+def get_validators(params, encoding=None):
+    '''Make the ETag and Last-Modified validators of a request from its
+    parameters and the content coding of the response. GetRecord responses
+    are validated by the datestamp of their record, and the others by the
+    change counter, which counts also removals without a later datestamp,
+    and the latest datestamp of the records they can show.
+
+    :returns: tuple of the ETag and the latest datestamp, or (None, None) if
+        the response of the request is not validated
+    '''
+    if params.get('verb') not in CONDITIONAL_VERBS:
+        return None, None
+    try:
+        set, from_, until = _get_list_arguments(params)
+    except (ErrorBase, DatestampError, ValueError):
+        # Bad arguments are reported by the server
+        return None, None
+    get_server()
+    if params['verb'] == 'GetRecord':
+        if not params.get('identifier'):
+            return None, None
+        last_modified = _ckan_server.getDatestamp(params['identifier'])
+        version = None
+    else:
+        last_modified = _ckan_server.lastModified(set, from_, until)
+        version = get_change_count()
+    if last_modified is None:
+        return None, None
+    etag = '"%s"' % hashlib.sha1(repr((sorted(params.items()), encoding, version,
+                                       last_modified.isoformat()))).hexdigest()
+    return etag, last_modified
+
+
+def _page_key(params):
+    return tuple(sorted((key, tuple(value) if isinstance(value, list) else value)
+                        for key, value in params.iteritems()))
+
+
+def handle_request(params):
+    '''Handle an OAI-PMH request. Responses of the `CACHED_VERBS` are served
+    from the page cache as long as no record, membership or set has changed
+    since they were made, with a new responseDate. Identical requests which
+    arrive while such a response is being made share it instead of making
+    their own.
+
+    :returns: string or iterable of strings
+    '''
+    server = get_server()
+    if params.get('verb') not in CACHED_VERBS:
+        return server.handleRequest(params)
+    key = _page_key(params)
+    if page_cache.size <= 0:
+        return request_flights.do(key, lambda: server.handleRequest(params))
+    watermark = get_change_count()
+    cached = page_cache.get(key)
+    if cached is not None and cached[0] == watermark:
+        watermark, head, tail = cached
+        response_date = datetime_to_datestamp(datetime.utcnow().replace(microsecond=0))
+        return ['%s<responseDate>%s</responseDate>' % (head, response_date)] + tail
+    return request_flights.do(key, lambda: _cache_page(key, watermark, server.handleRequest(params)))
+
+
+def _cache_page(key, watermark, body):
+    '''Generate the chunks of a response, and cache them once all of the
+    response has been generated. Responses larger than
+    `page_cache_max_bytes` are not kept.
+    '''
+    if isinstance(body, basestring):
+        body = [body]
+    chunks = []
+    size = 0
+    try:
+        for chunk in body:
+            if chunks is not None:
+                size += len(chunk)
+                if size > page_cache_max_bytes:
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    match = RESPONSE_DATE.search(chunks[0]) if chunks else None
+    if match:
+        page_cache.set(key, (watermark, chunks[0][:match.start()], [chunks[0][match.end():]] + chunks[1:]))
+
+
+def _is_not_modified(etag, last_modified):
+    '''Check the conditional headers of the request against the validators
+    of the response. If-None-Match takes precedence over If-Modified-Since.
+    '''
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        etags = [value.strip() for value in if_none_match.split(',')]
+        return '*' in etags or etag in etags or 'W/' + etag in etags
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since:
+        parsed = parsedate_tz(if_modified_since)
+        if parsed:
+            return calendar.timegm(last_modified.utctimetuple()) <= mktime_tz(parsed)
+    return False
+
 
 class OAIPMHController(BaseController):
     '''Controller for OAI-PMH server implementation. Returns only the index
@@ -19,23 +233,49 @@ class OAIPMHController(BaseController):
     '''
     def index(self):
         '''Return the result of the handled request of a batching OAI-PMH
-        server implementation.
+        server implementation. ListIdentifiers and ListRecords responses are
+        returned as iterables, which are streamed to the client.
+
+        Responses of the `CONDITIONAL_VERBS` have ETag and Last-Modified
+        headers, and conditional requests get 304 Not Modified if the
+        records have not changed since.
+
+        Responses are compressed with gzip or deflate if the client accepts
+        them. Pages of lists and records are served from the page cache
+        while the records have not changed. Complete ListRecords harvests are
+        served from the snapshot files, if there are any.
         '''
         if 'verb' in request.params:
             verb = request.params['verb'] if request.params['verb'] else None
             if verb:
-                client = CKANServer()
-                metadata_registry = oaimd.MetadataRegistry()
-                metadata_registry.registerReader('oai_dc', oaimd.oai_dc_reader)
-                metadata_registry.registerWriter('oai_dc', oaisrv.oai_dc_writer)
-                metadata_registry.registerReader('rdf', rdf_reader)
-                metadata_registry.registerWriter('rdf', dcat2rdf_writer)
-                serv = oaisrv.BatchingServer(client,
-                                             metadata_registry=metadata_registry,
-                                             resumption_batch_size=10)
                 parms = request.params.mixed()
-                res = serv.handleRequest(parms)
+                encoding = compression.choose_encoding(request.headers.get('Accept-Encoding'))
+                response.headers['Vary'] = 'Accept-Encoding'
+                page = snapshot.find_page(parms)
+                if page and encoding == 'gzip':
+                    # The page files are served as they are
+                    response.headers['content-type'] = 'text/xml; charset=utf-8'
+                    response.headers['Content-Encoding'] = encoding
+                    return snapshot.read_page(page, compressed=True)
+                if page:
+                    res = snapshot.read_page(page)
+                else:
+                    etag, last_modified = get_validators(parms, encoding)
+                    if etag:
+                        response.headers['ETag'] = etag
+                        response.headers['Last-Modified'] = formatdate(
+                            calendar.timegm(last_modified.utctimetuple()), usegmt=True)
+                        if _is_not_modified(etag, last_modified):
+                            response.status_int = 304
+                            return ''
+                    res = handle_request(parms)
                 response.headers['content-type'] = 'text/xml; charset=utf-8'
+                if encoding:
+                    response.headers['Content-Encoding'] = encoding
+                    level = asint(config.get('ckanext.oaipmh.compression_level', 6))
+                    if isinstance(res, basestring):
+                        return ''.join(compression.compress(res, encoding, level))
+                    return compression.compress(res, encoding, level)
                 return res
         else:
             return render('ckanext/oaipmh/oaipmh.html')
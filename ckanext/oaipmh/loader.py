@@ -0,0 +1,167 @@
+'''Bulk loading of dataset dictionaries for the OAI-PMH server.
+
+package_show runs validation, plugin hooks and a handful of queries for every
+dataset. The loader builds the same kind of dictionaries for a whole page of
+datasets with one query per related table.
+'''
+import re
+
+from sqlalchemy import func, select
+
+from ckan import model
+import utils
+
+# Kata stores lists of dicts, e.g. agents and pids, as extras like agent_0_name
+FLATTENED_EXTRA = re.compile(r'^(?P<field>[a-z]+)_(?P<index>\d+)_(?P<key>\w+)$')
+
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+
+def _table_dict(row):
+    '''Make a dictionary of a result row, dates in ISO format like
+    ckan.lib.dictization.table_dictize does.
+    '''
+    result = {}
+    for key, value in row.items():
+        result[key] = _isoformat(value) if hasattr(value, 'isoformat') else value
+    return result
+
+
+def _license(package):
+    '''Add license fields the same way as package_dictize.
+    '''
+    try:
+        license = model.Package.get_license_register()[package['license_id']]
+    except KeyError:
+        license = None
+    if license and license.url:
+        package['license_url'] = license.url
+        package['license_title'] = license.title.split('::')[-1]
+    elif license:
+        package['license_title'] = license.title
+    else:
+        package['license_title'] = package['license_id']
+    package['isopen'] = license.isopen() if license else False
+
+
+def _resource(row):
+    resource = _table_dict(row)
+    resource.update(resource.pop('extras', None) or {})
+    if resource.get('url_type') == 'upload' and resource.get('url') and '/' not in resource['url']:
+        resource['url'] = '%s/resource/%s/download/%s' % (
+            utils.get_dataset_url(resource['package_id']), resource['id'], resource['url'])
+    return resource
+
+
+def _add_extras(packages, ids):
+    extra = model.package_extra_table
+    query = select([extra.c.package_id, extra.c.key, extra.c.value]). \
+        where(extra.c.package_id.in_(ids)).where(extra.c.state == 'active'). \
+        order_by(extra.c.key)
+    flattened = {}
+    for package_id, key, value in model.Session.execute(query):
+        package = packages[package_id]
+        match = FLATTENED_EXTRA.match(key)
+        if match:
+            items = flattened.setdefault(package_id, {}).setdefault(match.group('field'), {})
+            items.setdefault(int(match.group('index')), {})[match.group('key')] = value
+        else:
+            package['extras'].append({'key': key, 'value': value})
+            package.setdefault(key, value)
+
+    for package_id, fields in flattened.iteritems():
+        for field, items in fields.iteritems():
+            packages[package_id][field] = [items[index] for index in sorted(items)]
+
+
+def _add_tags(packages, ids):
+    tag = model.tag_table
+    package_tag = model.package_tag_table
+    query = select([package_tag.c.package_id, tag.c.id, tag.c.name],
+                   from_obj=package_tag.join(tag, tag.c.id == package_tag.c.tag_id)). \
+        where(package_tag.c.package_id.in_(ids)).where(package_tag.c.state == 'active'). \
+        where(tag.c.vocabulary_id == None).order_by(tag.c.name)
+    for package_id, tag_id, name in model.Session.execute(query):
+        packages[package_id]['tags'].append({'id': tag_id, 'name': name, 'display_name': name,
+                                             'state': 'active', 'vocabulary_id': None})
+
+
+def _add_groups(packages, ids):
+    group = model.group_table
+    member = model.member_table
+    query = select([member.c.table_id, group],
+                   from_obj=member.join(group, group.c.id == member.c.group_id)). \
+        where(member.c.table_id.in_(ids)).where(member.c.table_name == 'package'). \
+        where(member.c.state == 'active').where(group.c.state == 'active'). \
+        where(group.c.is_organization == False).order_by(group.c.name)
+    for row in model.Session.execute(query):
+        group_dict = _table_dict(row)
+        package_id = group_dict.pop('table_id')
+        group_dict['display_name'] = group_dict.get('title') or group_dict['name']
+        packages[package_id]['groups'].append(group_dict)
+
+    org_ids = set(package['owner_org'] for package in packages.itervalues() if package['owner_org'])
+    if not org_ids:
+        return
+    query = select([group]).where(group.c.id.in_(org_ids)).where(group.c.state == 'active')
+    organizations = dict((row['id'], _table_dict(row)) for row in model.Session.execute(query))
+    for package in packages.itervalues():
+        package['organization'] = organizations.get(package['owner_org'])
+
+
+def _add_resources(packages, ids):
+    resource = model.resource_table
+    query = select([resource]).where(resource.c.package_id.in_(ids)). \
+        where(resource.c.state == 'active').order_by(resource.c.position)
+    for row in model.Session.execute(query):
+        packages[row['package_id']]['resources'].append(_resource(row))
+
+
+def _add_created(packages, ids):
+    revision = model.PackageRevision
+    query = model.Session.query(revision.id, func.min(revision.revision_timestamp)). \
+        filter(revision.id.in_(ids)).group_by(revision.id)
+    for package_id, created in query:
+        packages[package_id]['metadata_created'] = _isoformat(created)
+
+
+def load_packages(ids):
+    '''Build dataset dictionaries for a list of package ids.
+
+    The dictionaries have the package_show fields used by the OAI-PMH server:
+    package columns, extras, tags, groups, organization, resources and
+    license. Extras are also available as top level fields, and flattened
+    extras such as kata agents and pids are turned back into lists of dicts.
+
+    :param ids: list of package ids
+    :returns: dictionary of dataset dictionaries by package id
+    '''
+    if not ids:
+        return {}
+
+    package_table = model.package_table
+    query = select([package_table]).where(package_table.c.id.in_(ids))
+    packages = {}
+    for row in model.Session.execute(query):
+        package = _table_dict(row)
+        if package.get('title'):
+            package['title'] = package['title'].strip()
+        package['type'] = package['type'] or u'dataset'
+        package.update({'metadata_created': None, 'extras': [], 'tags': [], 'groups': [],
+                        'organization': None, 'resources': []})
+        _license(package)
+        packages[package['id']] = package
+
+    ids = packages.keys()
+    if ids:
+        _add_created(packages, ids)
+        _add_extras(packages, ids)
+        _add_tags(packages, ids)
+        _add_groups(packages, ids)
+        _add_resources(packages, ids)
+        for package in packages.itervalues():
+            package['num_tags'] = len(package['tags'])
+            package['num_resources'] = len(package['resources'])
+    return packages
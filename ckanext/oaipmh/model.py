@@ -0,0 +1,141 @@
+'''Database objects used by the OAI-PMH server.
+'''
+import logging
+
+from sqlalchemy import Column, Index, Sequence, Table, and_, event, exists, inspect, select, types
+from sqlalchemy.sql.expression import false, true
+
+from ckan import model
+
+log = logging.getLogger(__name__)
+
+# Lists are ordered and resumed by (metadata_modified, id)
+package_modified_index = Index('idx_oaipmh_package_modified_id',
+                               model.package_table.c.metadata_modified,
+                               model.package_table.c.id)
+
+# Header fields and rendered metadata of each public dataset, see records.py
+oaipmh_record_table = Table('oaipmh_record', model.meta.metadata,
+                            Column('id', types.UnicodeText, primary_key=True),
+                            Column('name', types.UnicodeText, nullable=False),
+                            Column('owner_org', types.UnicodeText),
+                            Column('set_spec', types.UnicodeText, nullable=False),
+                            Column('datestamp', types.DateTime, nullable=False),
+                            Column('deleted', types.Boolean, nullable=False, default=False),
+                            Column('oai_dc', types.UnicodeText),
+                            Column('rdf', types.UnicodeText))
+
+Index('idx_oaipmh_record_datestamp_id', oaipmh_record_table.c.datestamp, oaipmh_record_table.c.id)
+Index('idx_oaipmh_record_name', oaipmh_record_table.c.name)
+
+# Public datasets of each set by group id, with their datestamps, and the
+# datasets with deleted records, with their deletion times, see sets.py
+oaipmh_set_member_table = Table('oaipmh_set_member', model.meta.metadata,
+                                Column('set_id', types.UnicodeText, primary_key=True),
+                                Column('package_id', types.UnicodeText, primary_key=True),
+                                Column('datestamp', types.DateTime, nullable=False),
+                                Column('deleted', types.Boolean, nullable=False, default=False))
+
+Index('idx_oaipmh_set_member_set_datestamp_id', oaipmh_set_member_table.c.set_id,
+      oaipmh_set_member_table.c.datestamp, oaipmh_set_member_table.c.package_id)
+Index('idx_oaipmh_set_member_package', oaipmh_set_member_table.c.package_id)
+
+# Number of committed changes of datasets, their memberships and sets, which
+# validates the caches of all processes. A sequence is advanced without
+# locks, so concurrent transactions do not wait for each other.
+oaipmh_change_sequence = Sequence('oaipmh_change_seq', metadata=model.meta.metadata)
+
+_CHANGED = 'oaipmh_changed'
+
+
+def count_change():
+    '''Count a change of the current transaction. The count is advanced
+    once the transaction is committed, so that other processes never see
+    the new count before the change.
+    '''
+    model.Session().info[_CHANGED] = True
+
+
+def get_change_count():
+    '''Get the number of committed changes.
+    '''
+    row = model.Session.execute('SELECT last_value, is_called FROM %s' % oaipmh_change_sequence.name).first()
+    return row.last_value if row.is_called else 0
+
+
+def _after_commit(session):
+    if session.info.pop(_CHANGED, False):
+        model.meta.engine.execute(select([oaipmh_change_sequence.next_value()]))
+
+
+def _after_rollback(session):
+    session.info.pop(_CHANGED, None)
+
+
+def listen_changes():
+    '''Advance the change count when sessions with counted changes are
+    committed.
+    '''
+    for name, listener in (('after_commit', _after_commit), ('after_rollback', _after_rollback)):
+        if not event.contains(model.Session, name, listener):
+            event.listen(model.Session, name, listener)
+
+
+def set_member_select(package_ids=None, group_ids=None):
+    '''Select the rows of the set member table from the active memberships
+    of public datasets in active groups and organizations.
+
+    :param package_ids: optional list of package ids to select the rows of
+    :param group_ids: optional list of group ids to select the rows of
+    '''
+    member = model.member_table
+    package = model.package_table
+    group = model.group_table
+    conditions = [member.c.table_name == 'package', member.c.state == 'active', group.c.state == 'active',
+                  package.c.type == 'dataset', package.c.state == 'active', package.c.private != True]
+    if package_ids is not None:
+        conditions.append(package.c.id.in_(package_ids))
+    if group_ids is not None:
+        conditions.append(group.c.id.in_(group_ids))
+    return select([group.c.id, package.c.id, package.c.metadata_modified, false()]). \
+        select_from(member.join(package, package.c.id == member.c.table_id).
+                    join(group, group.c.id == member.c.group_id)). \
+        where(and_(*conditions)).distinct()
+
+
+def deleted_member_select():
+    '''Select deleted rows of the set member table for the deleted records
+    of organizations which have none.
+    '''
+    record = oaipmh_record_table
+    member = oaipmh_set_member_table
+    existing = select([member.c.package_id]).where(member.c.package_id == record.c.id)
+    return select([record.c.owner_org, record.c.id, record.c.datestamp, true()]). \
+        where(and_(record.c.deleted == True, record.c.owner_org != None, ~exists(existing)))
+
+
+def setup():
+    '''Create the indexes and tables needed by the OAI-PMH server if they
+    are missing.
+    '''
+    if not model.package_table.exists():
+        log.debug('OAI-PMH setup skipped, package table does not exist yet')
+        return
+
+    existing = [index['name'] for index in inspect(model.meta.engine).get_indexes('package')]
+    if package_modified_index.name not in existing:
+        log.info('Creating index %s', package_modified_index.name)
+        package_modified_index.create(bind=model.meta.engine)
+
+    if not oaipmh_record_table.exists():
+        log.info('Creating table %s, fill it with "paster oaipmh rebuild"', oaipmh_record_table.name)
+        oaipmh_record_table.create(bind=model.meta.engine)
+
+    if not oaipmh_set_member_table.exists():
+        log.info('Creating table %s', oaipmh_set_member_table.name)
+        oaipmh_set_member_table.create(bind=model.meta.engine)
+        for members in (set_member_select(), deleted_member_select()):
+            model.meta.engine.execute(oaipmh_set_member_table.insert().from_select(
+                ['set_id', 'package_id', 'datestamp', 'deleted'], members))
+
+    oaipmh_change_sequence.create(bind=model.meta.engine, checkfirst=True)
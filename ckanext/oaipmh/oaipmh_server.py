@@ -3,40 +3,163 @@
 # pylint: disable=E1101,E1103
 import json
 import logging
+import threading
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 
+import rdflib
 from oaipmh import common
 from oaipmh.common import ResumptionOAIPMH
 from oaipmh.error import IdDoesNotExistError
+from paste.deploy.converters import asint
 from pylons import config
-from sqlalchemy import between
+from sqlalchemy import or_, tuple_
+from sqlalchemy.sql.expression import false, true
 
-from ckan.lib.helpers import url_for
-from ckan.logic import get_action
-from ckan.model import Package, Session, Group, PackageRevision
+from ckan.model import Package, Session, Group
 from ckanext.dcat.processors import RDFSerializer
 from ckanext.kata import helpers
+from cache import ExpiringValue, LRUCache
+from loader import load_packages
+from model import oaipmh_record_table, oaipmh_set_member_table
+import sets
 import utils
 
 log = logging.getLogger(__name__)
 
-rdfserializer = RDFSerializer()
+
+class DatasetSerializer(RDFSerializer):
+    '''RDFSerializer which serializes each dataset in a graph of its own.
+
+    RDFSerializer adds every serialized dataset to the same graph, so each
+    serialization would also include all datasets serialized before it. The
+    profiles are loaded once and reused for all datasets.
+
+    The graph is an attribute of the serializer, so a serializer must not be
+    shared between threads. Use `get_rdf_serializer`.
+    '''
+    def serialize_dataset(self, dataset_dict, _format='xml'):
+        self.g = rdflib.Graph()
+        return super(DatasetSerializer, self).serialize_dataset(dataset_dict, _format)
+
+
+_local = threading.local()
+
+
+def get_rdf_serializer():
+    '''Return the RDF serializer of the current thread, creating it on the
+    first call of the thread.
+    '''
+    serializer = getattr(_local, 'rdfserializer', None)
+    if serializer is None:
+        serializer = _local.rdfserializer = DatasetSerializer()
+    return serializer
+
+
+# Rendered metadata by (dataset id, metadata_modified, metadataPrefix)
+record_cache = LRUCache(1000)
+
+# Identify of the repository, cleared when datasets change
+identify_cache = ExpiringValue(300)
+
+# Number of datasets loaded at a time while records are rendered
+render_chunk_size = 50
+
+# Threads rendering the records of a page, 0 renders them in the request thread
+render_threads = 0
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def configure(config):
+    '''Read the options of the server and size its caches. Called by the
+    plugin when CKAN is configured.
+    '''
+    global render_chunk_size, render_threads, _render_pool
+    record_cache.configure(asint(config.get('ckanext.oaipmh.record_cache_size', 1000)),
+                           config.get('ckanext.oaipmh.record_cache_dir', None))
+    identify_cache.ttl = asint(config.get('ckanext.oaipmh.identify_cache_ttl', 300))
+    identify_cache.clear()
+    render_chunk_size = asint(config.get('ckanext.oaipmh.render_chunk_size', 50))
+    with _render_pool_lock:
+        threads = asint(config.get('ckanext.oaipmh.render_threads', 0))
+        if _render_pool is not None and threads != render_threads:
+            _render_pool.close()
+            _render_pool = None
+        render_threads = threads
+
+
+def get_render_pool():
+    '''Return the thread pool of this process for rendering records, or None
+    if records are rendered in the request thread.
+    '''
+    global _render_pool
+    if render_threads <= 0:
+        return None
+    if _render_pool is None:
+        with _render_pool_lock:
+            if _render_pool is None:
+                _render_pool = ThreadPool(render_threads)
+    return _render_pool
+
+
+def filter_datestamps(query, column, from_=None, until=None):
+    '''Filter a query to datestamps from `from_` until `until`, both
+    inclusive. Datestamps are given in seconds, so `until` includes the
+    fractions of its second.
+    '''
+    if from_:
+        query = query.filter(column >= from_)
+    if until:
+        query = query.filter(column < until + timedelta(seconds=1))
+    return query
+
+
+class LazyRecords(object):
+    '''Records of a page whose metadata is rendered only while they are
+    iterated. The headers are made up front, so the length and the last
+    header of the page are known without rendering anything.
+
+    :param headers: list of headers
+    :param render: function that generates the records of a list of headers
+    '''
+    def __init__(self, headers, render):
+        self.headers = headers
+        self._render = render
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __iter__(self):
+        return self._render(self.headers)
+
+    def pop(self):
+        self.headers.pop()
 
 
 class CKANServer(ResumptionOAIPMH):
     '''A OAI-PMH implementation class for CKAN.
     '''
+    # Lists are ordered and resumed by these columns
+    _key_columns = (Package.metadata_modified, Package.id)
+
     def identify(self):
-        '''Return identification information for this server.
+        '''Return identification information for this server. The
+        information is cached in `identify_cache`.
         '''
+        return identify_cache.get(self._identify)
+
+    def _identify(self):
         return common.Identify(
             repositoryName=config.get('ckan.site_title', 'repository'),
-            baseURL=config.get('ckan.site_url', None) + url_for(controller='ckanext.oaipmh.controller:OAIPMHController', action='index'),
+            baseURL=utils.get_oai_url(),
             protocolVersion="2.0",
             adminEmails=['etsin@csc.fi'],
             earliestDatestamp=utils.get_earliest_datestamp(),
-            deletedRecord='no',
+            deletedRecord='persistent',
             granularity='YYYY-MM-DDThh:mm:ssZ',
-            compression=['identity'])
+            compression=['gzip', 'deflate'])
 
     def _get_json_content(self, js):
         '''
@@ -55,21 +178,21 @@ class CKANServer(ResumptionOAIPMH):
         except:
             return [js]
 
-    def _record_for_dataset_dcat(self, dataset, spec):
-        '''Show a tuple of a header and metadata for this dataset.
+    def _metadata_for_dataset_dcat(self, package):
+        '''Show the metadata for this dataset.
         Note that dataset_xml (metadata) returned is just a string containing
         ready rdf xml. This is contrary to the common practice of pyoia's
         getRecord method.
+
+        :param package: dataset dictionary from `load_packages`
         '''
-        package = get_action('package_show')({}, {'id': dataset.id})
-        dataset_xml = rdfserializer.serialize_dataset(package, _format='xml')
-        return (common.Header('', dataset.id, dataset.metadata_created, [spec], False),
-                dataset_xml, None)
+        return get_rdf_serializer().serialize_dataset(package, _format='xml')
+
+    def _metadata_for_dataset(self, package):
+        '''Show the metadata for this dataset.
 
-    def _record_for_dataset(self, dataset, spec):
-        '''Show a tuple of a header and metadata for this dataset.
+        :param package: dataset dictionary from `load_packages`
         '''
-        package = get_action('package_show')({}, {'id': dataset.id})
 
         coverage = []
         temporal_begin = package.get('temporal_coverage_begin', '')
@@ -83,7 +206,7 @@ class CKANServer(ResumptionOAIPMH):
 
         pids = [pid.get('id') for pid in package.get('pids', {}) if pid.get('id', False)]
         pids.append(package.get('id'))
-        pids.append(config.get('ckan.site_url') + url_for(controller="package", action='read', id=package['name']))
+        pids.append(utils.get_dataset_url(package['name']))
 
         meta = {'title': self._get_json_content(package.get('title', None) or package.get('name')),
                 'creator': [author['name'] for author in helpers.get_authors(package) if 'name' in author],
@@ -94,11 +217,11 @@ class CKANServer(ResumptionOAIPMH):
                 'language': [l.strip() for l in package.get('language').split(",")] if package.get('language', None) else None,
                 'description': self._get_json_content(package.get('notes')) if package.get('notes', None) else None,
                 'subject': [tag.get('display_name') for tag in package['tags']] if package.get('tags', None) else None,
-                'date': [dataset.metadata_created.strftime('%Y-%m-%d')] if dataset.metadata_created else None,
+                'date': [package['metadata_created'][:10]] if package.get('metadata_created') else None,
                 'rights': [package['license_title']] if package.get('license_title', None) else None,
                 'coverage': coverage if coverage else None, }
 
-        iters = dataset.extras.items()
+        iters = [(extra['key'], extra['value']) for extra in package.get('extras', [])]
         meta = dict(iters + meta.items())
         metadata = {}
         # Fixes the bug on having a large dataset being scrambled to individual
@@ -108,81 +231,236 @@ class CKANServer(ResumptionOAIPMH):
                 metadata[str(key)] = [value]
             else:
                 metadata[str(key)] = value
-        return (common.Header('', dataset.id, dataset.metadata_created, [spec], False),
-                common.Metadata('', metadata), None)
+        return common.Metadata('', metadata)
+
+    def _iter_records(self, headers, metadataPrefix):
+        '''Generate the records of headers, taking the metadata from the
+        record cache where possible. The other datasets are loaded
+        `render_chunk_size` at a time and their metadata rendered one record
+        at a time, so that only a chunk of datasets is kept in memory.
+
+        If `render_threads` is set, the chunks are split between the threads
+        of the render pool, and the records are generated in order as the
+        chunks are ready.
+        '''
+        pool = get_render_pool()
+        chunk_size = render_chunk_size
+        if pool is not None:
+            chunk_size = max(1, min(chunk_size, (len(headers) + render_threads - 1) // render_threads))
+        chunks = [headers[start:start + chunk_size] for start in xrange(0, len(headers), chunk_size)]
+        if pool is None or len(chunks) < 2:
+            for chunk in chunks:
+                for record in self._render_chunk(chunk, metadataPrefix):
+                    yield record
+            return
+        for records in pool.imap(lambda chunk: self._render_pooled(chunk, metadataPrefix), chunks):
+            for record in records:
+                yield record
+
+    def _render_pooled(self, headers, metadataPrefix):
+        '''Render a chunk of records in a thread of the render pool, which
+        has a database session of its own.
+        '''
+        try:
+            return list(self._render_chunk(headers, metadataPrefix))
+        finally:
+            Session.remove()
+
+    def _render_chunk(self, headers, metadataPrefix):
+        '''Generate the records of a chunk of headers.
+        '''
+        keys = [(header.identifier(), header.datestamp(), metadataPrefix) for header in headers]
+        cached = [record_cache.get(key) for key in keys]
+        package_dicts = load_packages([header.identifier() for header, metadata in zip(headers, cached)
+                                       if metadata is None and not header.isDeleted()])
+        for header, key, metadata in zip(headers, keys, cached):
+            if header.isDeleted():
+                yield header, None, None
+                continue
+            if metadata is None:
+                package = package_dicts.get(header.identifier())
+                if package is None:
+                    log.warning('Dataset %s was removed while its record was listed', header.identifier())
+                    continue
+                if metadataPrefix == 'rdf':
+                    metadata = self._metadata_for_dataset_dcat(package)
+                else:
+                    metadata = self._metadata_for_dataset(package)
+                record_cache.set(key, metadata)
+            yield header, metadata, None
 
     @staticmethod
-    def _filter_packages(set, cursor, from_, until, batch_size):
-        '''Get a part of datasets for "listNN" verbs.
+    def _package_query(set, from_, until):
+        '''Make a query of the datasets for "listNN" verbs.
+
+        Only the columns needed for headers are queried, so no Package
+        objects are created. Datasets of a set are selected from the set
+        member table by their datestamps there, and datasets of a shard set
+        by the hash of their ids. Deleted records of datasets which have
+        been deleted or made private are included, filtered by the set they
+        were members of or the shard of the set and by their deletion time.
+
+        :returns: tuple of the query of rows with id, name, metadata_modified,
+            owner_org and deleted, and the group of the set. The query is
+            None if the set does not exist.
         '''
-        packages = []
+        record = oaipmh_record_table
         group = None
-        if not set:
-            packages = Session.query(Package).filter(Package.type=='dataset'). \
-                filter(Package.state == 'active').filter(Package.private!=True)
-            if from_ and not until:
-                packages = packages.filter(PackageRevision.revision_timestamp > from_).\
-                    filter(Package.name==PackageRevision.name)
-            if until and not from_:
-                packages = packages.filter(PackageRevision.revision_timestamp < until).\
-                    filter(Package.name==PackageRevision.name)
-            if from_ and until:
-                packages = packages.filter(between(PackageRevision.revision_timestamp, from_, until)).\
-                    filter(Package.name==PackageRevision.name)
-            packages = packages.all()
-        else:
+        packages = Session.query(Package.id, Package.name, Package.metadata_modified, Package.owner_org,
+                                 false().label('deleted')). \
+            filter(Package.type == 'dataset').filter(Package.state == 'active').filter(Package.private != True)
+        deleted = Session.query(record.c.id, record.c.name, record.c.datestamp, record.c.owner_org, true()). \
+            filter(record.c.deleted == True)
+        shard = sets.parse_shard(set)
+        if shard:
+            if shard[1] > 1:
+                packages = packages.filter(sets.shard_filter(Package.id, *shard))
+                deleted = deleted.filter(sets.shard_filter(record.c.id, *shard))
+        elif set:
             group = Group.get(set)
-            if group:
-                # Note that group.packages never returns private datasets regardless of 'with_private' parameter.
-                packages = group.packages(return_query=True, with_private=False).filter(Package.type=='dataset'). \
-                    filter(Package.state == 'active')
-                if from_ and not until:
-                    packages = packages.filter(PackageRevision.revision_timestamp > from_).\
-                        filter(Package.name==PackageRevision.name)
-                if until and not from_:
-                    packages = packages.filter(PackageRevision.revision_timestamp < until).\
-                        filter(Package.name==PackageRevision.name)
-                if from_ and until:
-                    packages = packages.filter(between(PackageRevision.revision_timestamp, from_, until)).\
-                        filter(Package.name==PackageRevision.name)
-                packages = packages.all()
-        if cursor is not None:
-            cursor_end = cursor + batch_size if cursor + batch_size < len(packages) else len(packages)
-            packages = packages[cursor:cursor_end]
-        return packages, group
+            if not group:
+                return None, group
+            # The set member table has the datasets of sets with their
+            # datestamps, and the datasets with deleted records with their
+            # deletion times. The datasets are checked again, in case the
+            # table is behind.
+            member = oaipmh_set_member_table
+            packages = Session.query(member.c.package_id.label('id'), Package.name,
+                                     member.c.datestamp.label('metadata_modified'), Package.owner_org,
+                                     false().label('deleted')). \
+                join(Package, Package.id == member.c.package_id). \
+                filter(member.c.set_id == group.id).filter(member.c.deleted == False). \
+                filter(Package.type == 'dataset').filter(Package.state == 'active').filter(Package.private != True)
+            deleted = Session.query(member.c.package_id, record.c.name, member.c.datestamp, record.c.owner_org,
+                                    true()). \
+                join(record, record.c.id == member.c.package_id). \
+                filter(member.c.set_id == group.id).filter(member.c.deleted == True).filter(record.c.deleted == True)
+            packages = filter_datestamps(packages, member.c.datestamp, from_, until)
+            deleted = filter_datestamps(deleted, member.c.datestamp, from_, until)
+            return packages.union_all(deleted), group
+        # The datestamps of headers are indexed with the ids
+        packages = filter_datestamps(packages, Package.metadata_modified, from_, until)
+        deleted = filter_datestamps(deleted, record.c.datestamp, from_, until)
+        return packages.union_all(deleted), group
+
+    @classmethod
+    def _get_key_columns(cls, group=None):
+        '''Get the columns by which lists are ordered and resumed. Lists of a
+        set are ordered by the set member table.
+        '''
+        if group is not None:
+            member = oaipmh_set_member_table
+            return member.c.datestamp, member.c.package_id
+        return cls._key_columns
+
+    @classmethod
+    def _filter_packages(cls, set, cursor, from_, until, batch_size, after=None):
+        '''Get a part of datasets for "listNN" verbs.
+
+        Paging is done in the database, so that only `batch_size` rows are
+        fetched for each page. If `after` is given as a tuple of
+        metadata_modified and id, the page continues right after that package
+        instead of skipping `cursor` packages.
+
+        :returns: tuple of rows with id, name, metadata_modified and
+            owner_org, and the group of the set
+        '''
+        packages, group = cls._package_query(set, from_, until)
+        if packages is None:
+            return [], group
+        key_columns = cls._get_key_columns(group)
+        packages = packages.order_by(*key_columns)
+        if after is not None:
+            packages = packages.filter(tuple_(*key_columns) > tuple_(*after)). \
+                limit(batch_size)
+        elif cursor is not None:
+            packages = packages.offset(cursor).limit(batch_size)
+        return packages.all(), group
+
+    def listSize(self, verb, set=None, from_=None, until=None):
+        '''Count the items of a complete list for the completeListSize of
+        resumption tokens.
+        '''
+        if verb == 'ListSets':
+            return len(sets.list_sets())
+        if set and from_ is None and until is None:
+            size = sets.set_size(set)
+            if size is not None:
+                return size
+        packages, group = self._package_query(set, from_, until)
+        return packages.count() if packages is not None else 0
+
+    def lastModified(self, set=None, from_=None, until=None):
+        '''Get the latest datestamp of the records of a list, or of all
+        records, for validating cached responses.
+
+        :returns: datetime, or None if there are no records
+        '''
+        packages, group = self._package_query(set, from_, until)
+        if packages is None:
+            return None
+        datestamp = self._get_key_columns(group)[0]
+        return packages.with_entities(datestamp).order_by(datestamp.desc()).limit(1).scalar()
+
+    @staticmethod
+    def _headers(packages, group=None):
+        '''Make the headers of packages. The setSpec is the requested set,
+        the name of the owner organization or the name of the package.
+        All owner organizations of the packages are resolved with one query.
+        Packages with a true `deleted` attribute get deleted headers.
+        '''
+        if group:
+            specs = dict((package.id, group.name) for package in packages)
+        else:
+            org_ids = set(package.owner_org for package in packages if package.owner_org)
+            org_names = {}
+            if org_ids:
+                org_names = dict(Session.query(Group.id, Group.name).filter(Group.id.in_(org_ids)))
+            specs = dict((package.id, org_names.get(package.owner_org) or package.name) for package in packages)
+        return [common.Header('', package.id, package.metadata_modified, [specs[package.id]],
+                              getattr(package, 'deleted', False))
+                for package in packages]
+
+    def _get_record_row(self, identifier):
+        '''Get the header fields of a record by the id or name of its dataset.
+        Datasets which have been deleted or made private have a deleted
+        record, which is also found by the name or id of purged datasets.
+
+        :returns: Package or row with id, name, metadata_modified, owner_org
+            and deleted, or None if there is no record
+        '''
+        package = Package.get(identifier)
+        if package and package.type == 'dataset' and package.state == 'active' and not package.private:
+            return package
+        record = oaipmh_record_table
+        rows = Session.query(record.c.id, record.c.name, record.c.datestamp.label('metadata_modified'),
+                             record.c.owner_org, record.c.deleted).filter(record.c.deleted == True)
+        if package:
+            return rows.filter(record.c.id == package.id).first()
+        return rows.filter(or_(record.c.id == identifier, record.c.name == identifier)).first()
+
+    def getDatestamp(self, identifier):
+        '''Get the datestamp of a record for validating GetRecord responses.
+
+        :returns: datetime, or None if there is no record
+        '''
+        row = self._get_record_row(identifier)
+        return row.metadata_modified if row is not None else None
 
     def getRecord(self, metadataPrefix, identifier):
         '''Simple getRecord for a dataset.
         '''
-        package = Package.get(identifier)
-        if not package:
+        row = self._get_record_row(identifier)
+        if row is None:
             raise IdDoesNotExistError("No dataset with id %s" % identifier)
-        spec = package.name
-        if package.owner_org:
-            group = Group.get(package.owner_org)
-            if group and group.name:
-                spec = group.name
-        if metadataPrefix == 'rdf':
-            return self._record_for_dataset_dcat(package, spec)
-        return self._record_for_dataset(package, spec)
+        return next(self._iter_records(self._headers([row]), metadataPrefix))
 
     def listIdentifiers(self, metadataPrefix=None, set=None, cursor=None,
-                        from_=None, until=None, batch_size=None):
+                        from_=None, until=None, batch_size=None, after=None):
         '''List all identifiers for this repository.
         '''
-        data = []
-        packages, group = self._filter_packages(set, cursor, from_, until, batch_size)
-        for package in packages:
-            spec = package.name
-            if group:
-                spec = group.name
-            else:
-                if package.owner_org:
-                    group = Group.get(package.owner_org)
-                    if group and group.name:
-                        spec = group.name
-            data.append(common.Header('', package.id, package.metadata_created, [spec], False))
-        return data
+        packages, group = self._filter_packages(set, cursor, from_, until, batch_size, after)
+        return self._headers(packages, group)
 
     def listMetadataFormats(self, identifier=None):
         '''List available metadata formats.
@@ -195,34 +473,21 @@ class CKANServer(ResumptionOAIPMH):
                  'http://www.openarchives.org/OAI/2.0/rdf/')]
 
     def listRecords(self, metadataPrefix=None, set=None, cursor=None, from_=None,
-                    until=None, batch_size=None):
+                    until=None, batch_size=None, after=None):
         '''Show a selection of records, basically lists all datasets.
+
+        The records are returned as `LazyRecords`, which render their
+        metadata only when iterated.
         '''
-        data = []
-        packages, group = self._filter_packages(set, cursor, from_, until, batch_size)
-        for package in packages:
-            spec = package.name
-            if group:
-                spec = group.name
-            else:
-                if package.owner_org:
-                    group = Group.get(package.owner_org)
-                    if group and group.name:
-                        spec = group.name
-            if metadataPrefix == 'rdf':
-                data.append(self._record_for_dataset_dcat(package, spec))
-            else:
-                data.append(self._record_for_dataset(package, spec))
-        return data
+        packages, group = self._filter_packages(set, cursor, from_, until, batch_size, after)
+        headers = self._headers(packages, group)
+        return LazyRecords(headers, lambda headers: self._iter_records(headers, metadataPrefix))
 
     def listSets(self, cursor=None, batch_size=None):
-        '''List all sets in this repository, where sets are groups.
+        '''List all sets in this repository, where sets are groups and
+        organizations. The sets are cached in `sets.set_cache`.
         '''
-        data = []
-        groups = Session.query(Group).filter(Group.state == 'active')
+        data = [(name, title, description) for name, title, description, group_id, size in sets.list_sets()]
         if cursor is not None:
-            cursor_end = cursor+batch_size if cursor+batch_size < groups.count() else groups.count()
-            groups = groups[cursor:cursor_end]
-        for dataset in groups:
-            data.append((dataset.name, dataset.title, dataset.description))
+            data = data[cursor:cursor + batch_size]
         return data
@@ -1,11 +1,36 @@
 import logging
 import os
+from sqlalchemy import event
 from ckan.plugins import implements, SingletonPlugin
-from ckan.plugins import IRoutes, IConfigurer
+from ckan.plugins import IRoutes, IConfigurer, IConfigurable, IPackageController
+from ckan.plugins import IDomainObjectModification, IGroupController, IOrganizationController
+
+from ckan import model
+from ckanext.oaipmh import model as oaipmh_model
+from ckanext.oaipmh import records
+from ckanext.oaipmh import oaipmh_server
+from ckanext.oaipmh import sets
+from ckanext.oaipmh.oaipmh_server import identify_cache
 
 log = logging.getLogger(__name__)
 
 
+def _after_bulk_update(update_context):
+    '''Follow bulk updates of datasets, like bulk_update_private and
+    bulk_update_delete, which call no plugin hooks. The records and the set
+    memberships of the datasets, found again by the criteria of the update,
+    are updated as by the hooks.
+    '''
+    if update_context.primary_table is not model.package_table:
+        return
+    statement = update_context.context.statement.with_only_columns([model.package_table.c.id])
+    ids = [package_id for package_id, in update_context.session.execute(statement, params=update_context.query._params)]
+    records.update_records(ids, render=records.enabled())
+    sets.update_memberships(ids)
+    oaipmh_model.count_change()
+    identify_cache.clear()
+
+
 class OAIPMHPlugin(SingletonPlugin):
     '''OAI-PMH plugin, maps the controller and uses the template configuration
     stanza to have the template render in case there is no parameters to the
@@ -13,6 +38,80 @@ class OAIPMHPlugin(SingletonPlugin):
     '''
     implements(IRoutes, inherit=True)
     implements(IConfigurer)
+    implements(IConfigurable)
+    implements(IPackageController, inherit=True)
+    implements(IDomainObjectModification, inherit=True)
+    implements(IGroupController, inherit=True)
+    implements(IOrganizationController, inherit=True)
+
+    def configure(self, config):
+        '''Read the options of the OAI-PMH server, size its caches, create
+        the database objects it needs and follow bulk updates of datasets.
+        '''
+        from ckanext.oaipmh import controller
+
+        oaipmh_server.configure(config)
+        sets.configure(config)
+        controller.configure(config)
+        oaipmh_model.setup()
+        oaipmh_model.listen_changes()
+        if not event.contains(model.Session, 'after_bulk_update', _after_bulk_update):
+            event.listen(model.Session, 'after_bulk_update', _after_bulk_update)
+
+    def after_create(self, context, pkg_dict):
+        '''Add the record of a new dataset to the record table.
+        '''
+        records.update_records([pkg_dict['id']], render=records.enabled())
+        identify_cache.clear()
+
+    def after_update(self, context, pkg_dict):
+        '''Update the record of a dataset in the record table. Datasets made
+        private get deleted records.
+        '''
+        records.update_records([pkg_dict['id']], render=records.enabled())
+        identify_cache.clear()
+
+    def after_delete(self, context, pkg_dict):
+        '''Replace the record of a deleted dataset with a deleted record.
+        '''
+        package = model.Package.get(pkg_dict['id'])
+        if package:
+            records.tombstone_records([package.id])
+        identify_cache.clear()
+
+    def notify(self, entity, operation):
+        '''Update the set memberships of a dataset when it or its
+        memberships change, and count the change for the page caches. Purged
+        datasets, for which after_delete is not called, get deleted records.
+        Called before the changes are committed.
+        '''
+        if isinstance(entity, model.Package):
+            if operation == model.DomainObjectOperation.deleted:
+                records.tombstone_purged(entity)
+                identify_cache.clear()
+            sets.update_memberships([entity.id])
+            oaipmh_model.count_change()
+
+    def create(self, entity):
+        '''Add a new group or organization to the sets.
+        '''
+        if isinstance(entity, model.Group):
+            sets.set_cache.clear()
+            oaipmh_model.count_change()
+
+    def edit(self, entity):
+        '''Update the set of a changed group or organization.
+        '''
+        if isinstance(entity, model.Group):
+            sets.update_set(entity.id)
+            oaipmh_model.count_change()
+
+    def delete(self, entity):
+        '''Remove the set of a deleted group or organization.
+        '''
+        if isinstance(entity, model.Group):
+            sets.update_set(entity.id)
+            oaipmh_model.count_change()
 
     def update_config(self, config):
         """This IConfigurer implementation causes CKAN to look in the
@@ -1,5 +1,7 @@
 '''RDF reader and writer for OAI-PMH harvester and server interface
 '''
+import re
+
 from lxml import etree
 from oaipmh.metadata import MetadataReader
 from oaipmh.server import NS_DC
@@ -8,6 +10,8 @@ NSRDF = 'http://www.openarchives.org/OAI/2.0/rdf/'
 NSOW = 'http://www.ontoweb.org/ontology/1#'
 RDF_SCHEMA = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
 
+XML_DECLARATION = re.compile(r'^\s*<\?xml[^>]*\?>\s*')
+
 rdf_reader = MetadataReader(
     fields={'title': ('textList', 'rdf:RDF/ow:Publication/dc:title/text()'),
             'creator': ('textList', 'rdf:RDF/ow:Publication/dc:creator/text()'),
@@ -41,6 +45,18 @@ def dcat2rdf_writer(element, metadata):
     element.append(e_dc)
 
 
+def rdf_fragment(metadata):
+    ''' Turn metadata from ckanext-dcat into bytes which can be written into
+    a response as they are, without parsing them to etree.
+
+    :param metadata: Ready string of rdf xml
+    :returns: The rdf xml in UTF-8 without the XML declaration
+    '''
+    if isinstance(metadata, unicode):
+        metadata = metadata.encode('utf-8')
+    return XML_DECLARATION.sub('', metadata, count=1)
+
+
 def nsrdf(name):
     return '{%s}%s' % (NSRDF, name)
 
@@ -0,0 +1,262 @@
+'''Materialized OAI-PMH records.
+
+The oaipmh_record table keeps the header fields and the rendered oai_dc and
+rdf metadata of every public dataset. With ckanext.oaipmh.record_table
+enabled, the table is updated when datasets change and `RecordServer`
+answers the OAI-PMH verbs from it, so that listing records is a range scan
+of one table. ``paster oaipmh rebuild`` fills the table from scratch.
+
+Datasets which are deleted or made private after being public always get
+deleted records in the table, which both servers list with their deletion
+time.
+'''
+import json
+import logging
+from collections import namedtuple
+from datetime import datetime
+
+from oaipmh import common
+from paste.deploy.converters import asbool
+from pylons import config
+from sqlalchemy import and_, or_, select
+
+from ckan.model import Package, Session, Group, PackageRevision
+from loader import load_packages
+from model import oaipmh_record_table, oaipmh_set_member_table
+from oaipmh_server import CKANServer, filter_datestamps
+import oaipmh_server
+import sets
+
+log = logging.getLogger(__name__)
+
+_PurgedRow = namedtuple('_PurgedRow', 'id name owner_org organization')
+
+
+def enabled():
+    '''Return True if the record table is maintained and served.
+    '''
+    return asbool(config.get('ckanext.oaipmh.record_table', False))
+
+
+def _is_public(package):
+    return package.type == 'dataset' and package.state == 'active' and not package.private
+
+
+def _package_rows(ids):
+    '''Query the fields of datasets needed for their records. Other types
+    of packages, like harvest sources, have no records.
+    '''
+    return Session.query(Package.id, Package.name, Package.owner_org, Package.type, Package.state,
+                         Package.private, Package.metadata_modified, Group.name.label('organization')). \
+        outerjoin(Group, Group.id == Package.owner_org).filter(Package.id.in_(ids)). \
+        filter(Package.type == 'dataset').all()
+
+
+def _record(server, row, package):
+    '''Make the row of the record table for a dataset dictionary.
+    '''
+    rdf = server._metadata_for_dataset_dcat(package)
+    return {'id': row.id,
+            'name': row.name,
+            'owner_org': row.owner_org,
+            'set_spec': row.organization or row.name,
+            'datestamp': row.metadata_modified,
+            'deleted': False,
+            'oai_dc': json.dumps(server._metadata_for_dataset(package).getMap()),
+            'rdf': rdf.decode('utf-8') if isinstance(rdf, str) else rdf}
+
+
+def _tombstone(rows):
+    '''Replace the records of datasets with deleted records, which tell
+    harvesters that the datasets are gone. Only datasets which have once
+    been public get deleted records, and the deletion time of datasets which
+    already have one is kept.
+    '''
+    record = oaipmh_record_table
+    ids = [row.id for row in rows]
+    if not ids:
+        return
+    deleted = set(record_id for record_id, in Session.query(record.c.id).
+                  filter(record.c.id.in_(ids)).filter(record.c.deleted == True))
+    published = set(package_id for package_id, in Session.query(PackageRevision.id).
+                    filter(PackageRevision.id.in_(ids)).filter(PackageRevision.type == 'dataset').
+                    filter(PackageRevision.state == 'active').filter(PackageRevision.private != True).distinct())
+    _insert_tombstones([row for row in rows if row.id in published and row.id not in deleted])
+
+
+def _insert_tombstones(rows):
+    '''Insert deleted records, and turn the set memberships of the datasets
+    into deleted memberships so that their sets list them as deleted.
+    '''
+    if not rows:
+        return
+    now = datetime.utcnow()
+    delete_records([row.id for row in rows])
+    sets.delete_memberships([row.id for row in rows], now)
+    Session.execute(oaipmh_record_table.insert(), [{'id': row.id,
+                                                    'name': row.name,
+                                                    'owner_org': row.owner_org,
+                                                    'set_spec': row.organization or row.name,
+                                                    'datestamp': now,
+                                                    'deleted': True} for row in rows])
+
+
+def delete_records(ids):
+    '''Remove the records of datasets, including deleted records and their
+    deleted set memberships.
+    '''
+    if ids:
+        Session.execute(oaipmh_record_table.delete().where(oaipmh_record_table.c.id.in_(ids)))
+        sets.remove_deleted_memberships(ids)
+
+
+def tombstone_records(ids):
+    '''Give datasets which are being deleted deleted records.
+
+    :param ids: list of package ids
+    '''
+    _tombstone(_package_rows(ids))
+
+
+def tombstone_purged(package):
+    '''Give a dataset which is being purged a deleted record. The dataset
+    and its revisions are already gone from the database, so it counts as
+    once public if it is public or has a record, and its fields are taken
+    from the object.
+
+    :param package: Package being purged
+    '''
+    if package.type != 'dataset':
+        return
+    record = oaipmh_record_table
+    deleted = Session.query(record.c.deleted).filter(record.c.id == package.id).scalar()
+    if deleted or (deleted is None and not _is_public(package)):
+        return
+    organization = None
+    if package.owner_org:
+        organization = Session.query(Group.name).filter(Group.id == package.owner_org).scalar()
+    _insert_tombstones([_PurgedRow(package.id, package.name, package.owner_org, organization)])
+
+
+def update_records(ids, render=True):
+    '''Update the records of datasets. Public datasets have their records
+    rendered again, or only their deleted records removed if `render` is
+    false. Other datasets get deleted records. Pending changes of the
+    session are flushed first, so the records match what is about to be
+    committed.
+
+    :param ids: list of package ids
+    :returns: number of rendered records
+    '''
+    Session.flush()
+    server = CKANServer()
+    count = 0
+    chunk_size = oaipmh_server.render_chunk_size
+    for start in xrange(0, len(ids), chunk_size):
+        rows = _package_rows(ids[start:start + chunk_size])
+        public = [row for row in rows if _is_public(row)]
+        delete_records([row.id for row in public])
+        if render and public:
+            packages = load_packages([row.id for row in public])
+            records = [_record(server, row, packages[row.id]) for row in public if row.id in packages]
+            if records:
+                Session.execute(oaipmh_record_table.insert(), records)
+            count += len(records)
+        _tombstone([row for row in rows if not _is_public(row)])
+    return count
+
+
+def rebuild():
+    '''Replace the records of all datasets. Deleted records are kept, and
+    added for datasets which have once been public and are missing one.
+
+    :returns: number of rendered records
+    '''
+    Session.execute(oaipmh_record_table.delete().where(oaipmh_record_table.c.deleted == False))
+    ids = [package_id for package_id, in Session.query(Package.id).
+           filter(Package.type == 'dataset').order_by(Package.id)]
+    count = update_records(ids)
+    log.info('Rebuilt %d OAI-PMH records', count)
+    return count
+
+
+class RecordServer(CKANServer):
+    '''OAI-PMH server which answers from the record table instead of
+    rendering datasets at request time.
+    '''
+    _key_columns = (oaipmh_record_table.c.datestamp, oaipmh_record_table.c.id)
+
+    @staticmethod
+    def _record_query():
+        record = oaipmh_record_table
+        return Session.query(record.c.id, record.c.name, record.c.datestamp.label('metadata_modified'),
+                             record.c.owner_org, record.c.set_spec, record.c.deleted)
+
+    @classmethod
+    def _package_query(cls, set, from_, until):
+        '''Make a query of the records for "listNN" verbs.
+
+        :returns: tuple of the query and the group of the set. The query is
+            None if the set does not exist.
+        '''
+        record = oaipmh_record_table
+        group = None
+        records = cls._record_query()
+        shard = sets.parse_shard(set)
+        if shard:
+            if shard[1] > 1:
+                records = records.filter(sets.shard_filter(record.c.id, *shard))
+        elif set:
+            group = Group.get(set)
+            if not group:
+                return None, group
+            # Records of a set are selected from the set member table by
+            # their datestamps there, which has deleted memberships for
+            # deleted records
+            member = oaipmh_set_member_table
+            records = Session.query(member.c.package_id.label('id'), record.c.name,
+                                    member.c.datestamp.label('metadata_modified'), record.c.owner_org,
+                                    record.c.set_spec, record.c.deleted). \
+                join(record, and_(record.c.id == member.c.package_id, record.c.deleted == member.c.deleted)). \
+                filter(member.c.set_id == group.id)
+            return filter_datestamps(records, member.c.datestamp, from_, until), group
+        return filter_datestamps(records, record.c.datestamp, from_, until), group
+
+    @staticmethod
+    def _headers(records, group=None):
+        return [common.Header('', record.id, record.metadata_modified,
+                              [group.name if group else record.set_spec], record.deleted)
+                for record in records]
+
+    def _iter_records(self, headers, metadataPrefix):
+        '''Generate the records of headers, reading the metadata of
+        `render_chunk_size` records at a time.
+        '''
+        record = oaipmh_record_table
+        column = record.c.rdf if metadataPrefix == 'rdf' else record.c.oai_dc
+        chunk_size = oaipmh_server.render_chunk_size
+        for start in xrange(0, len(headers), chunk_size):
+            chunk = headers[start:start + chunk_size]
+            ids = [header.identifier() for header in chunk if not header.isDeleted()]
+            payloads = {}
+            if ids:
+                payloads = dict(Session.execute(select([record.c.id, column]).where(record.c.id.in_(ids))).fetchall())
+            for header in chunk:
+                if header.isDeleted():
+                    yield header, None, None
+                    continue
+                payload = payloads.get(header.identifier())
+                if payload is None:
+                    log.warning('Record %s was removed while it was listed', header.identifier())
+                    continue
+                if metadataPrefix == 'rdf':
+                    metadata = payload.encode('utf-8')
+                else:
+                    metadata = common.Metadata('', json.loads(payload))
+                yield header, metadata, None
+
+    def _get_record_row(self, identifier):
+        '''Get the header fields of a record by the id or name of its dataset.
+        '''
+        record = oaipmh_record_table
+        return self._record_query().filter(or_(record.c.id == identifier, record.c.name == identifier)).first()
@@ -0,0 +1,170 @@
+'''Resumption token handling for the OAI-PMH server.
+
+pyoai's BatchingServer continues a list from an offset cursor. The classes
+here can instead continue from the last (datestamp, identifier) pair that was
+sent, so that every page is a range scan of the same cost.
+'''
+from datetime import datetime
+
+import oaipmh.server as oaisrv
+from lxml.etree import SubElement
+from oaipmh import common
+from oaipmh.error import BadResumptionTokenError, NoRecordsMatchError
+
+KEY_DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def encode_key(header):
+    '''Encode the position of a header for a resumption token.
+
+    :param header: the last header of a page
+    :returns: string with the full precision datestamp and the identifier
+    '''
+    return '%s,%s' % (header.datestamp().isoformat(), header.identifier())
+
+
+def decode_key(value):
+    '''Decode a position encoded with `encode_key`.
+
+    :param value: encoded position from a resumption token
+    :returns: tuple of datestamp and identifier
+    '''
+    datestamp, _, identifier = value.partition(',')
+    for datetime_format in KEY_DATETIME_FORMATS:
+        try:
+            return datetime.strptime(datestamp, datetime_format), identifier
+        except ValueError:
+            pass
+    raise BadResumptionTokenError("Unable to decode resumption token (bad position): %s" % value)
+
+
+class ResumptionToken(object):
+    '''A resumption token with its completeListSize and cursor attributes.
+    An empty value marks the last page of a resumed list.
+    '''
+    def __init__(self, value, cursor, complete_list_size=None):
+        self.value = value
+        self.cursor = cursor
+        self.complete_list_size = complete_list_size
+
+
+class ResumingXMLTreeServer(oaisrv.XMLTreeServer):
+    '''XMLTreeServer that writes `ResumptionToken` objects, including their
+    completeListSize and cursor attributes.
+    '''
+    def _resume(self, input_func, kw):
+        '''Get a page of a list.
+
+        :returns: tuple of the page, its resumption token and the arguments
+            of the original request
+        '''
+        if 'resumptionToken' in kw:
+            result, token = input_func(resumptionToken=kw['resumptionToken'])
+            token_kw, dummy = oaisrv.decodeResumptionToken(kw['resumptionToken'])
+        else:
+            result, token = input_func(**kw)
+            # No results for the first request means that no records match
+            if not result:
+                raise NoRecordsMatchError("No records match for request.")
+            token_kw = kw
+        return result, token, token_kw
+
+    def _outputResumptionToken(self, element, token):
+        e_resumptionToken = SubElement(element, oaisrv.nsoai('resumptionToken'))
+        if token.complete_list_size is not None:
+            e_resumptionToken.set('completeListSize', str(token.complete_list_size))
+        e_resumptionToken.set('cursor', str(token.cursor))
+        e_resumptionToken.text = token.value or None
+
+    def _outputResuming(self, element, input_func, output_func, kw):
+        result, token, token_kw = self._resume(input_func, kw)
+        output_func(element, result, token_kw)
+        if token is not None:
+            self._outputResumptionToken(element, token)
+
+
+class KeysetBatchingResumption(oaisrv.BatchingResumption):
+    '''Turns an IBatchingOAIPMH interface into a ResumptionOAIPMH interface.
+
+    The "listNN" methods of the server get the position of the last record
+    of the previous page as the `after` keyword argument. The cursor is still
+    kept in the token, as pyoai needs one to decode it.
+
+    The size of the complete list is counted with the `listSize` method of
+    the server when the first page is made, and carried in the tokens of the
+    following pages.
+
+    Results with a `pop` method, like lazily rendered records, are used as
+    they are instead of being turned into lists.
+
+    :param batch_sizes: page sizes by (verb, metadataPrefix) or (verb, None)
+        used instead of `batch_size`
+    '''
+    def __init__(self, server, batch_size=10, keyset=True, batch_sizes=None):
+        super(KeysetBatchingResumption, self).__init__(server, batch_size)
+        self._keyset = keyset
+        self._batch_sizes = batch_sizes or {}
+
+    def _get_batch_size(self, verb, kw):
+        return self._batch_sizes.get((verb, kw.get('metadataPrefix')),
+                                     self._batch_sizes.get((verb, None), self._batch_size))
+
+    def handleVerb(self, verb, kw):
+        resumed = 'resumptionToken' in kw
+        if resumed:
+            kw, cursor = oaisrv.decodeResumptionToken(kw['resumptionToken'])
+            kw['cursor'] = cursor
+            if 'after' in kw:
+                kw['after'] = decode_key(kw['after'])
+
+        method = common.getMethodForVerb(self._server, verb)
+
+        if verb not in ['ListSets', 'ListIdentifiers', 'ListRecords']:
+            return method(**kw)
+
+        kw = kw.copy()
+        try:
+            complete_list_size = int(kw.pop('size', None) or 0) or None
+        except ValueError:
+            raise BadResumptionTokenError("Unable to decode resumption token (bad size)")
+        cursor = kw.get('cursor', None)
+        if cursor is None:
+            kw['cursor'] = cursor = 0
+        batch_size = self._get_batch_size(verb, kw)
+        # Request one beyond the batch size to know whether another page follows
+        kw['batch_size'] = batch_size + 1
+        result = method(**kw)
+        if not hasattr(result, 'pop'):
+            result = list(result)
+        if len(result) <= batch_size:
+            if resumed:
+                return result, ResumptionToken('', cursor, complete_list_size)
+            return result, None
+
+        result.pop()
+        if complete_list_size is None:
+            complete_list_size = self._server.listSize(
+                verb, set=kw.get('set'), from_=kw.get('from_'), until=kw.get('until'))
+        token_kw = kw.copy()
+        del token_kw['batch_size']
+        token_kw.pop('after', None)
+        token_kw['size'] = complete_list_size
+        if self._keyset and verb != 'ListSets':
+            # Lazy results have their headers available without rendering
+            last = getattr(result, 'headers', result)[-1]
+            token_kw['after'] = encode_key(last[0] if isinstance(last, tuple) else last)
+        token = oaisrv.encodeResumptionToken(token_kw, cursor + batch_size)
+        return result, ResumptionToken(token, cursor, complete_list_size)
+
+
+class KeysetBatchingServer(oaisrv.ServerBase):
+    '''Expects to be initialized with a IBatchingOAI server implementation,
+    which accepts the `after` keyword argument for ListIdentifiers and
+    ListRecords and has a `listSize` method.
+    '''
+    def __init__(self, server, metadata_registry=None, nsmap=None,
+                 resumption_batch_size=10, keyset=True, batch_sizes=None):
+        self._tree_server = ResumingXMLTreeServer(
+            KeysetBatchingResumption(server, resumption_batch_size, keyset, batch_sizes),
+            metadata_registry,
+            nsmap)
@@ -0,0 +1,186 @@
+'''OAI-PMH sets.
+
+The oaipmh_set_member table indexes the public datasets of each group and
+organization by their datestamps, so that a list restricted to a set is a
+range scan of the index. The memberships of datasets which get deleted
+records are kept as deleted memberships, dated by the deletion, so that
+their sets list them as deleted. The table is updated when datasets or
+their memberships change, and ``paster oaipmh rebuild`` fills it again.
+
+The sets with their titles and sizes are cached in `set_cache` for ListSets
+and the completeListSize of set lists, as long as the change counter of all
+processes stays the same.
+
+With ckanext.oaipmh.shards = N, ListSets also lists the virtual sets
+``shard:0-of-N`` ... ``shard:<N-1>-of-N``, which split all records by a hash
+of their identifiers, so that harvesters can list the records of the shards
+in parallel. Any ``shard:i-of-M`` set can be harvested, also for other
+numbers of shards. The names of groups and organizations cannot contain a
+colon, so only the ``shard:`` prefix is reserved.
+'''
+import hashlib
+import logging
+import re
+
+from paste.deploy.converters import asint
+from sqlalchemy import BigInteger, cast, func, literal, or_, select
+from sqlalchemy.dialects.postgresql import BIT
+
+from ckan.model import Group, Package, Session
+from cache import ExpiringValue
+from model import deleted_member_select, get_change_count, oaipmh_set_member_table, set_member_select
+
+log = logging.getLogger(__name__)
+
+# Tuples of name, title, description, id and size of all sets
+set_cache = ExpiringValue(3600)
+
+# Number of shard sets listed by ListSets, 0 lists none
+shard_count = 0
+
+SHARD_SET = 'shard'
+SHARD_SPEC = re.compile(r'^shard:(\d+)-of-(\d+)$')
+
+
+def configure(config):
+    '''Read the options of sets. Called by the plugin when CKAN is
+    configured.
+    '''
+    global shard_count
+    set_cache.ttl = asint(config.get('ckanext.oaipmh.set_cache_ttl', 3600))
+    shard_count = asint(config.get('ckanext.oaipmh.shards', 0))
+    set_cache.clear()
+
+
+def parse_shard(set_spec):
+    '''Parse the spec of a shard set.
+
+    :returns: tuple of the index and the number of shards, or None if the
+        spec is not of a valid shard set
+    '''
+    match = SHARD_SPEC.match(set_spec or '')
+    if not match:
+        return None
+    index, count = int(match.group(1)), int(match.group(2))
+    if count < 1 or index >= count:
+        return None
+    return index, count
+
+
+def shard_of(identifier, count):
+    '''Get the shard of an identifier, as computed by `shard_filter`.
+    '''
+    return int(hashlib.md5(identifier.encode('utf-8')).hexdigest()[:8], 16) % count
+
+
+def shard_filter(column, index, count):
+    '''Make a filter of the rows whose identifiers are in a shard. The shard
+    is the first 32 bits of the MD5 hash of the identifier modulo the number
+    of shards.
+    '''
+    digest = literal('x') + func.substr(func.md5(column), 1, 8)
+    return cast(cast(digest, BIT(32)), BigInteger) % count == index
+
+
+def _shard_sets():
+    return [('%s:%d-of-%d' % (SHARD_SET, index, shard_count),
+             'Shard %d of %d' % (index + 1, shard_count), '', None, None)
+            for index in xrange(shard_count)]
+
+
+def _insert_members(members):
+    Session.execute(oaipmh_set_member_table.insert().from_select(
+        ['set_id', 'package_id', 'datestamp', 'deleted'], members))
+
+
+def update_memberships(package_ids):
+    '''Update the set memberships of datasets. Deleted memberships are
+    kept, unless the datasets are public again. Pending changes of the
+    session are flushed first.
+
+    :param package_ids: list of package ids
+    '''
+    if not package_ids:
+        return
+    Session.flush()
+    member = oaipmh_set_member_table
+    public = select([Package.id]).where(Package.id.in_(package_ids)).where(Package.type == 'dataset'). \
+        where(Package.state == 'active').where(Package.private != True)
+    Session.execute(member.delete().where(member.c.package_id.in_(package_ids)).
+                    where(or_(member.c.deleted == False, member.c.package_id.in_(public))))
+    _insert_members(set_member_select(package_ids=package_ids))
+    set_cache.clear()
+
+
+def delete_memberships(package_ids, datestamp):
+    '''Turn the set memberships of datasets which get deleted records into
+    deleted memberships.
+
+    :param datestamp: deletion time of the datasets
+    '''
+    member = oaipmh_set_member_table
+    Session.execute(member.update().where(member.c.package_id.in_(package_ids)).where(member.c.deleted == False).
+                    values(deleted=True, datestamp=datestamp))
+    set_cache.clear()
+
+
+def remove_deleted_memberships(package_ids):
+    '''Remove the deleted set memberships of datasets whose deleted records
+    are removed.
+    '''
+    member = oaipmh_set_member_table
+    Session.execute(member.delete().where(member.c.package_id.in_(package_ids)).where(member.c.deleted == True))
+
+
+def update_set(group_id):
+    '''Update the memberships of a group or organization, which are removed
+    if it has been deleted. Deleted memberships are kept.
+    '''
+    Session.flush()
+    member = oaipmh_set_member_table
+    Session.execute(member.delete().where(member.c.set_id == group_id).where(member.c.deleted == False))
+    _insert_members(set_member_select(group_ids=[group_id]))
+    set_cache.clear()
+
+
+def rebuild():
+    '''Replace all set memberships. Deleted memberships are kept, and
+    added by the organization for deleted records which have none.
+    '''
+    Session.execute(oaipmh_set_member_table.delete().where(oaipmh_set_member_table.c.deleted == False))
+    _insert_members(set_member_select())
+    _insert_members(deleted_member_select())
+    set_cache.clear()
+
+
+def _list_sets():
+    '''List the active groups and organizations with the number of their
+    records, including deleted records, followed by the shard sets.
+    '''
+    member = oaipmh_set_member_table
+    sizes = dict(Session.query(member.c.set_id, func.count(member.c.package_id)).group_by(member.c.set_id))
+    groups = Session.query(Group.id, Group.name, Group.title, Group.description). \
+        filter(Group.state == 'active').order_by(Group.name)
+    data = [(group.name, group.title, group.description, group.id, sizes.get(group.id, 0)) for group in groups]
+    data.extend(_shard_sets())
+    return data
+
+
+def list_sets():
+    '''Get the cached list of sets. The list is made again when a change
+    has been counted by any process.
+
+    :returns: list of tuples of name, title, description, id and number of
+        records of each set. The id and the size of shard sets are None.
+    '''
+    return set_cache.get(_list_sets, get_change_count())
+
+
+def set_size(name):
+    '''Get the cached number of records of a set, or None for shard sets
+    and unknown sets.
+    '''
+    for set_spec, title, description, group_id, size in list_sets():
+        if set_spec == name:
+            return size
+    return None
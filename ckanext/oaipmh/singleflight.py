@@ -0,0 +1,203 @@
+'''Coalescing of concurrent identical requests.
+
+When requests with the same key arrive while the response for the key is
+being made, they wait for that response instead of making their own. The
+first request streams its response and keeps none of it if nobody waits for
+it when the response starts. Otherwise it makes the rest of the response at
+once into a buffer which all the requests read, so that none of them is held
+up by a slow client of another.
+
+Waiting requests make their own response if the shared one does not start
+within `timeout` seconds.
+'''
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class _Timeout(Exception):
+    pass
+
+
+class _Flight(object):
+    '''The chunks of a response being made, shared by the requests of the
+    same key.
+    '''
+    def __init__(self):
+        self.chunks = []
+        self.followers = 0
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def add(self, chunk):
+        with self.condition:
+            self.chunks.append(chunk)
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    def read(self, timeout):
+        '''Generate the chunks of the response, waiting at most `timeout`
+        seconds for each one which has not been made yet.
+        '''
+        index = 0
+        while True:
+            with self.condition:
+                deadline = time.time() + timeout
+                while index >= len(self.chunks) and not self.done:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise _Timeout()
+                    self.condition.wait(remaining)
+                if index < len(self.chunks):
+                    chunk = self.chunks[index]
+                elif self.error is not None:
+                    raise RuntimeError('Coalesced response failed: %s' % self.error)
+                else:
+                    return
+            index += 1
+            yield chunk
+
+
+def _iterate(body):
+    if isinstance(body, basestring):
+        body = [body]
+    try:
+        for chunk in body:
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+class SingleFlight(object):
+    '''Makes only one response at a time for each key.
+
+    The counters tell how many responses have been made, how many requests
+    have been served by the response of another request and how many of
+    those gave up waiting and made their own.
+
+    :param timeout: seconds a request waits for each chunk of a shared
+        response
+    '''
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self.executed = 0
+        self.coalesced = 0
+        self.timed_out = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def stats(self):
+        '''Return the counters and the number of responses being made.
+        '''
+        with self._lock:
+            return {'executed': self.executed, 'coalesced': self.coalesced, 'timed_out': self.timed_out,
+                    'in_flight': len(self._flights)}
+
+    def do(self, key, function):
+        '''Return the response of `function`, or the response being made
+        for the same key by another request.
+
+        :param key: hashable key of the request
+        :param function: function returning a string or an iterable of
+            strings
+        :returns: iterable of strings
+        '''
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.executed += 1
+            else:
+                flight.followers += 1
+                self.coalesced += 1
+        if not leader:
+            log.debug('Coalesced request %r', key)
+            return self._follow(key, flight, function)
+        try:
+            body = function()
+        except Exception as e:
+            self._land(key, flight, e)
+            raise
+        if isinstance(body, basestring):
+            body = [body]
+        return self._generate(key, flight, body)
+
+    def _land(self, key, flight, error=None):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.finish(error)
+
+    def _shared(self, key, flight):
+        '''Return True if requests wait for a flight, or else end the flight
+        so that no more requests join it.
+        '''
+        with self._lock:
+            if flight.followers:
+                return True
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            return False
+
+    def _generate(self, key, flight, body):
+        '''Generate the response of the first request. The response is
+        streamed if nobody waits for it when its first chunk is made, and
+        otherwise made into the flight before it is generated.
+        '''
+        error = None
+        try:
+            chunks = iter(body)
+            for chunk in chunks:
+                if not self._shared(key, flight):
+                    yield chunk
+                    for chunk in chunks:
+                        yield chunk
+                    return
+                flight.add(chunk)
+                for chunk in chunks:
+                    flight.add(chunk)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            self._land(key, flight, error)
+        for chunk in flight.chunks:
+            yield chunk
+
+    def _follow(self, key, flight, function):
+        '''Generate the shared response of a waiting request, or its own
+        response if the shared one does not start in time. A shared response
+        which stops in the middle is an error.
+        '''
+        chunks = flight.read(self.timeout)
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        except _Timeout:
+            log.warning('Coalesced request %r timed out, making its own response', key)
+            with self._lock:
+                self.timed_out += 1
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            for chunk in _iterate(function()):
+                yield chunk
+            return
+        yield chunk
+        try:
+            for chunk in chunks:
+                yield chunk
+        except _Timeout:
+            raise RuntimeError('Coalesced response %r timed out' % (key,))
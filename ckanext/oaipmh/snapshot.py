@@ -0,0 +1,197 @@
+'''Snapshots of complete ListRecords harvests.
+
+``paster oaipmh snapshot`` lists all records once for each metadata prefix
+and writes the pages of the lists as gzip files in the directory set by
+ckanext.oaipmh.snapshot_dir. The resumption tokens of the pages are replaced
+with snapshot tokens pointing to the following files, and the responseDate of
+every page is the time when the snapshot was started.
+
+ListRecords requests without a set, from or until, and requests with
+snapshot tokens, are then served from the files. A harvester which continues
+with incremental harvests from the responseDate gets the records changed
+after the snapshot from the server.
+'''
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+from datetime import datetime
+
+from lxml import etree
+from oaipmh.datestamp import datetime_to_datestamp
+from paste.deploy.converters import asint
+from pylons import config
+
+log = logging.getLogger(__name__)
+
+MANIFEST = 'snapshot.json'
+
+SNAPSHOT_ID = re.compile(r'^\d{14}$')
+
+TOKEN = re.compile(r'^snapshot:(\d{14}):([A-Za-z0-9_-]+):(\d+)$')
+
+NS_OAI = '{http://www.openarchives.org/OAI/2.0/}'
+
+# Number of snapshots kept, so that harvesters can finish the previous one
+KEEP_SNAPSHOTS = 2
+
+READ_SIZE = 64 * 1024
+
+_manifest = (None, None)
+_manifest_lock = threading.Lock()
+
+
+def get_snapshot_dir():
+    '''Return the snapshot directory, or None if snapshots are not used.
+    '''
+    return config.get('ckanext.oaipmh.snapshot_dir') or None
+
+
+def snapshot_token(snapshot_id, prefix, page):
+    return 'snapshot:%s:%s:%d' % (snapshot_id, prefix, page)
+
+
+def _page_path(directory, snapshot_id, prefix, page):
+    return os.path.join(directory, snapshot_id, prefix, '%d.xml.gz' % page)
+
+
+def _rewrite_page(page, snapshot_id, prefix, number, response_date):
+    '''Replace the responseDate and the resumption tokens of a page.
+
+    :returns: tuple of the page and the resumption token of the next page in
+        the original page, or None if it is the last page
+    '''
+    root = etree.fromstring(page)
+    root.find(NS_OAI + 'responseDate').text = response_date
+    request = root.find(NS_OAI + 'request')
+    if 'resumptionToken' in request.attrib:
+        request.set('resumptionToken', snapshot_token(snapshot_id, prefix, number))
+    token = root.find('.//' + NS_OAI + 'resumptionToken')
+    next_token = token.text if token is not None else None
+    if next_token:
+        token.text = snapshot_token(snapshot_id, prefix, number + 1)
+    return etree.tostring(root, xml_declaration=True, encoding='utf-8'), next_token
+
+
+def _write_prefix(server, directory, snapshot_id, prefix, response_date):
+    '''Write the pages of the complete ListRecords list of a metadata prefix.
+
+    :returns: number of pages, or 0 if the list is empty
+    '''
+    level = asint(config.get('ckanext.oaipmh.compression_level', 6))
+    params = {'verb': 'ListRecords', 'metadataPrefix': prefix}
+    number = 0
+    while True:
+        body = server.handleRequest(params)
+        page = body if isinstance(body, basestring) else ''.join(body)
+        if number == 0 and etree.fromstring(page).find(NS_OAI + 'error') is not None:
+            log.info('No %s records for the snapshot', prefix)
+            return 0
+        page, next_token = _rewrite_page(page, snapshot_id, prefix, number, response_date)
+        page_file = gzip.open(_page_path(directory, snapshot_id, prefix, number), 'wb', level)
+        try:
+            page_file.write(page)
+        finally:
+            page_file.close()
+        number += 1
+        if not next_token:
+            return number
+        params = {'verb': 'ListRecords', 'resumptionToken': next_token}
+
+
+def write_snapshot(server, directory, prefixes):
+    '''Write a snapshot and make it the current one. Older snapshots than the
+    previous one are removed.
+
+    :param server: OAI-PMH server with a handleRequest method
+    :param directory: snapshot directory
+    :param prefixes: metadata prefixes to write the records of
+    :returns: manifest of the snapshot
+    '''
+    started = datetime.utcnow().replace(microsecond=0)
+    snapshot_id = started.strftime('%Y%m%d%H%M%S')
+    response_date = datetime_to_datestamp(started)
+    pages = {}
+    for prefix in prefixes:
+        os.makedirs(os.path.join(directory, snapshot_id, prefix))
+        count = _write_prefix(server, directory, snapshot_id, prefix, response_date)
+        if count:
+            pages[prefix] = count
+        log.info('Wrote %d pages of %s records', count, prefix)
+    manifest = {'id': snapshot_id, 'datestamp': response_date, 'pages': pages}
+    temporary = os.path.join(directory, MANIFEST + '.tmp')
+    with open(temporary, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.rename(temporary, os.path.join(directory, MANIFEST))
+
+    snapshots = sorted(name for name in os.listdir(directory) if SNAPSHOT_ID.match(name))
+    for name in snapshots[:-KEEP_SNAPSHOTS]:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    return manifest
+
+
+def get_manifest(directory):
+    '''Get the manifest of the current snapshot, read again only when the
+    file has changed.
+
+    :returns: dictionary with the id, datestamp and numbers of pages by
+        metadata prefix of the snapshot, or None if there is none
+    '''
+    global _manifest
+    path = os.path.join(directory, MANIFEST)
+    try:
+        modified = os.stat(path).st_mtime
+    except OSError:
+        return None
+    with _manifest_lock:
+        if _manifest[0] != (path, modified):
+            with open(path) as manifest_file:
+                _manifest = (path, modified), json.load(manifest_file)
+        return _manifest[1]
+
+
+def find_page(params):
+    '''Find the snapshot page file of a request.
+
+    :returns: path of the gzip file of the page, or None if the request is
+        not served from a snapshot or the file has been removed
+    '''
+    directory = get_snapshot_dir()
+    if not directory or params.get('verb') != 'ListRecords':
+        return None
+    if any(not isinstance(value, basestring) for value in params.itervalues()):
+        return None
+    if 'resumptionToken' in params:
+        if len(params) != 2:
+            return None
+        match = TOKEN.match(params['resumptionToken'])
+        if not match:
+            return None
+        path = _page_path(directory, match.group(1), match.group(2), int(match.group(3)))
+        return path if os.path.exists(path) else None
+    if sorted(params) != ['metadataPrefix', 'verb']:
+        return None
+    manifest = get_manifest(directory)
+    if not manifest or params['metadataPrefix'] not in manifest['pages']:
+        return None
+    path = _page_path(directory, manifest['id'], params['metadataPrefix'], 0)
+    return path if os.path.exists(path) else None
+
+
+def read_page(path, compressed=False):
+    '''Generate the contents of a page file.
+
+    :param compressed: generate the gzip data of the file instead of the page
+    '''
+    page_file = open(path, 'rb') if compressed else gzip.open(path, 'rb')
+    try:
+        while True:
+            data = page_file.read(READ_SIZE)
+            if not data:
+                break
+            yield data
+    finally:
+        page_file.close()
@@ -0,0 +1,91 @@
+'''Streamed responses for the OAI-PMH list verbs.
+
+pyoai builds the whole response tree of a request in memory and serialises it
+to one string. The server here writes the envelope first and then each
+header or record on its own, so that a response can be returned to WSGI as an
+iterable of XML chunks. Ready RDF XML is written into the chunks as it is,
+without parsing it.
+'''
+import logging
+
+import oaipmh.server as oaisrv
+from lxml import etree
+from oaipmh.error import CannotDisseminateFormatError
+
+from ckan.model import Session
+from rdftools import rdf_fragment
+from resumption import KeysetBatchingServer
+
+log = logging.getLogger(__name__)
+
+PLACEHOLDER = 'oaipmh-stream'
+PLACEHOLDER_COMMENT = '<!--%s-->' % PLACEHOLDER
+
+
+def _serialize(element, xml_declaration=False):
+    return etree.tostring(element, encoding='UTF-8', xml_declaration=xml_declaration,
+                          pretty_print=True, with_tail=False)
+
+
+class StreamingBatchingServer(KeysetBatchingServer):
+    '''Batching server which returns the responses of ListIdentifiers and
+    ListRecords as iterables of XML chunks. Other verbs and errors are
+    returned as strings.
+
+    The page query, the resumption token and the envelope are made and the
+    metadata prefix is checked before the iterable is returned, so that
+    errors in the request are still reported as OAI-PMH errors.
+    '''
+    def handleVerb(self, verb, kw):
+        tree_server = self._tree_server
+        if verb == 'ListRecords':
+            input_func = tree_server._server.listRecords
+        elif verb == 'ListIdentifiers':
+            input_func = tree_server._server.listIdentifiers
+        else:
+            return super(StreamingBatchingServer, self).handleVerb(verb, kw)
+
+        result, token, token_kw = tree_server._resume(input_func, kw)
+        metadata_prefix = token_kw['metadataPrefix']
+        if not tree_server._metadata_registry.hasWriter(metadata_prefix):
+            raise CannotDisseminateFormatError("Unknown metadata format: %s" % metadata_prefix)
+        envelope, e_verb = tree_server._outputEnvelope(verb=verb, **kw)
+        e_verb.append(etree.Comment(PLACEHOLDER))
+        head, tail = _serialize(envelope.getroot(), xml_declaration=True).split(PLACEHOLDER_COMMENT)
+        return self._stream(head, tail, verb, result, token, metadata_prefix)
+
+    def _container(self, verb):
+        return etree.Element(oaisrv.nsoai(verb), nsmap=self._tree_server._nsmap)
+
+    def _stream(self, head, tail, verb, result, token, metadata_prefix):
+        '''Generate the response in chunks of a header or a record.
+        '''
+        tree_server = self._tree_server
+        try:
+            yield head
+            for item in result:
+                container = self._container(verb)
+                if verb == 'ListRecords':
+                    header, metadata, about = item
+                    e_record = etree.SubElement(container, oaisrv.nsoai('record'))
+                    tree_server._outputHeader(e_record, header)
+                    if not header.isDeleted() and metadata_prefix == 'rdf':
+                        e_metadata = etree.SubElement(e_record, oaisrv.nsoai('metadata'))
+                        e_metadata.append(etree.Comment(PLACEHOLDER))
+                        record_head, record_tail = _serialize(e_record).split(PLACEHOLDER_COMMENT)
+                        yield record_head + rdf_fragment(metadata) + record_tail
+                        continue
+                    if not header.isDeleted():
+                        tree_server._outputMetadata(e_record, metadata_prefix, metadata)
+                else:
+                    tree_server._outputHeader(container, item)
+                yield _serialize(container[0])
+            if token is not None:
+                container = self._container(verb)
+                tree_server._outputResumptionToken(container, token)
+                yield _serialize(container[0])
+            yield tail
+        finally:
+            # The request has ended before the response is iterated, so the
+            # session used here is not removed by the controller
+            Session.remove()
@@ -6,9 +6,15 @@ Functional tests for OAI-PMH harvester.
 """
 
 import datetime
+import shutil
+import tempfile
+import threading
+import zlib
 from unittest import TestCase
 
 import oaipmh.client
+import oaipmh.metadata as oaimd
+import oaipmh.server as oaisrv
 import ckan
 import random
 
@@ -23,13 +29,27 @@ from ckan.tests import WsgiAppCase
 from ckan.lib.helpers import url_for
 
 import lxml.etree
+import rdflib
+from rdflib.compare import isomorphic
+from sqlalchemy import event
 from ckan.logic import get_action
 from ckan import model
+from ckanext.oaipmh import model as oaipmh_model
+from ckanext.oaipmh import records
+from ckanext.oaipmh import sets
+from ckanext.oaipmh import snapshot
+from ckanext.oaipmh import utils as oaipmh_utils
+from ckanext.oaipmh.streaming import StreamingBatchingServer
+from ckanext.oaipmh.loader import load_packages
+from ckanext.oaipmh import oaipmh_server
+from ckanext.oaipmh.oaipmh_server import CKANServer, record_cache
+from ckanext.oaipmh.resumption import KeysetBatchingServer
 from ckanext.kata.tests.test_fixtures.unflattened import TEST_DATADICT
 
 from copy import deepcopy
 import os
 
+from pylons import config
 from pylons.util import AttribSafeContextObj, PylonsContext, pylons
 
 
@@ -53,6 +73,7 @@ class TestReadingFixtures(TestCase):
         model.repo.rebuild_db()
         harvest_model.setup()
         kata_model.setup()
+        oaipmh_model.setup()
         cls.harvester = OAIPMHHarvester()
 
         # The Pylons globals are not available outside a request. This is a hack to provide context object.
@@ -119,6 +140,7 @@ class TestOaipmhServer(WsgiAppCase, TestCase):
         model.repo.rebuild_db()
         harvest_model.setup()
         kata_model.setup()
+        oaipmh_model.setup()
 
         # The Pylons globals are not available outside a request. This is a hack to provide context object.
         c = AttribSafeContextObj()
@@ -129,6 +151,7 @@ class TestOaipmhServer(WsgiAppCase, TestCase):
     @classmethod
     def teardown(cls):
         ckan.model.repo.rebuild_db()
+        sets.set_cache.clear()
 
     def _get_results(self, xml, xpath):
         return xml.xpath(xpath, namespaces=self._namespaces)
@@ -138,6 +161,17 @@ class TestOaipmhServer(WsgiAppCase, TestCase):
         self.assertEquals(len(results), 1)
         return results[0]
 
+    def _create_packages(self, user, organization, count):
+        packages = []
+        for i in range(count):
+            package_data = deepcopy(TEST_DATADICT)
+            package_data['owner_org'] = organization['name']
+            package_data['private'] = False
+            for pid in package_data.get('pids', []):
+                pid['id'] = utils.generate_pid()
+            packages.append(get_action('package_create')({'user': user}, package_data))
+        return packages
+
     def test_coverage(self):
         model.User(name="test_coverage", sysadmin=True).save()
         organization = get_action('organization_create')({'user': 'test_coverage'}, {'name': 'test-organization-coverage', 'title': "Test organization"})
@@ -188,7 +222,8 @@ class TestOaipmhServer(WsgiAppCase, TestCase):
         get_action('organization_delete')({'user': 'test_coverage'}, {'id': organization['id']})
 
     def test_coverage_temporal_rdf(self):
-        """ For some reason _get_results(... "...*") finds temporal nodes four times.
+        """ Test that the record has only the temporal coverage of its own dataset,
+        even though other datasets have been serialized before it.
         """
         organization = get_action('organization_create')({'user': 'test_coverage'}, {'name': 'test-organization-coverage-rdf2', 'title': "Test organization rdf 2"})
         package_1_data = deepcopy(TEST_DATADICT)
@@ -209,7 +244,7 @@ class TestOaipmhServer(WsgiAppCase, TestCase):
         for temporal in self._get_results(root, "//dct:temporal/dct:PeriodOfTime/*"):
             self.assertTrue(temporal.text in expected)
             found += 1
-        self.assertEquals(4, found, "Unexpected coverage results: {f}".format(f=found))
+        self.assertEquals(2, found, "Unexpected coverage results: {f}".format(f=found))
 
         get_action('organization_delete')({'user': 'test_coverage'}, {'id': organization['id']})
 
@@ -320,3 +355,633 @@ class TestOaipmhServer(WsgiAppCase, TestCase):
             self.assertTrue(identifier == package2['id'])
 
         get_action('organization_delete')({'user': 'privateuser'}, {'id': organization['id']})
+
+    def test_list_paging(self):
+        '''
+        Test that only a single page of packages is fetched from the database
+        '''
+        model.User(name="test_paging", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_paging'}, {'name': 'test-organization-paging', 'title': "Test organization paging"})
+        packages = self._create_packages('test_paging', organization, 5)
+        model.Session.remove()
+
+        loaded = []
+        fetched = []
+
+        def count_loaded(target, context):
+            loaded.append(target.id)
+
+        def count_fetched(conn, cursor, statement, parameters, context, executemany):
+            if 'FROM package ' in statement:
+                fetched.append(cursor.rowcount)
+
+        event.listen(model.Package, 'load', count_loaded)
+        event.listen(model.meta.engine, 'after_cursor_execute', count_fetched)
+        try:
+            first_page = CKANServer().listIdentifiers(metadataPrefix='oai_dc', cursor=0, batch_size=2)
+            second_page = CKANServer().listIdentifiers(metadataPrefix='oai_dc', cursor=2, batch_size=2)
+        finally:
+            event.remove(model.Package, 'load', count_loaded)
+            event.remove(model.meta.engine, 'after_cursor_execute', count_fetched)
+
+        self.assertEquals(fetched, [2, 2])
+        self.assertEquals(loaded, [])
+
+        identifiers = [header.identifier() for header in first_page + second_page]
+        self.assertEquals(len(set(identifiers)), 4)
+        self.assertTrue(set(identifiers) <= set(package['id'] for package in packages))
+
+        get_action('organization_delete')({'user': 'test_paging'}, {'id': organization['id']})
+
+    def test_keyset_resumption(self):
+        '''
+        Test that walking a list with keyset resumption tokens returns every package once
+        '''
+        model.User(name="test_keyset", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_keyset'}, {'name': 'test-organization-keyset', 'title': "Test organization keyset"})
+        packages = self._create_packages('test_keyset', organization, 5)
+
+        server = KeysetBatchingServer(CKANServer(), resumption_batch_size=2)
+        root = lxml.etree.fromstring(server.handleRequest({'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc'}))
+        identifiers = []
+        while True:
+            identifiers.extend(self._get_results(root, "//o:header/o:identifier/text()"))
+            token_element = self._get_single_result(root, "//o:resumptionToken")
+            self.assertEquals(token_element.get('completeListSize'), '5')
+            self.assertEquals(token_element.get('cursor'), str(len(identifiers) - len(self._get_results(root, "//o:header"))))
+            token = token_element.text
+            if not token:
+                break
+            self.assertTrue('after' in token)
+            root = lxml.etree.fromstring(server.handleRequest({'verb': 'ListIdentifiers', 'resumptionToken': token}))
+
+        self.assertEquals(len(identifiers), 5)
+        self.assertEquals(set(identifiers), set(package['id'] for package in packages))
+
+        get_action('organization_delete')({'user': 'test_keyset'}, {'id': organization['id']})
+
+    def test_list_records_query_count(self):
+        '''
+        Test that the number of queries for a page of records does not grow with the page size
+        '''
+        model.User(name="test_query_count", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_query_count'}, {'name': 'test-organization-query-count', 'title': "Test organization query count"})
+        self._create_packages('test_query_count', organization, 4)
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(model.meta.engine, 'before_cursor_execute', count_statement)
+        try:
+            model.Session.remove()
+            record_cache.clear()
+            small_page = CKANServer().listRecords(metadataPrefix='oai_dc', cursor=0, batch_size=2)
+            lazy_count = len(statements)
+            small_records = list(small_page)
+            small_count = len(statements)
+            del statements[:]
+            model.Session.remove()
+            record_cache.clear()
+            large_records = list(CKANServer().listRecords(metadataPrefix='oai_dc', cursor=0, batch_size=4))
+            large_count = len(statements)
+        finally:
+            event.remove(model.meta.engine, 'before_cursor_execute', count_statement)
+
+        self.assertEquals(len(small_records), 2)
+        self.assertEquals(len(large_records), 4)
+        self.assertEquals(small_count, large_count)
+        # Datasets are loaded only when the records are iterated
+        self.assertTrue(lazy_count < small_count)
+
+        get_action('organization_delete')({'user': 'test_query_count'}, {'id': organization['id']})
+
+    def test_list_set_specs(self):
+        '''
+        Test that each header gets the set of its own organization
+        '''
+        model.User(name="test_set_specs", sysadmin=True).save()
+        organizations = [get_action('organization_create')({'user': 'test_set_specs'}, {'name': 'test-organization-specs-%d' % i, 'title': "Test organization specs"})
+                         for i in range(2)]
+        org_names = {}
+        for organization in organizations:
+            for package in self._create_packages('test_set_specs', organization, 2):
+                org_names[package['id']] = organization['name']
+
+        url = url_for('/oai')
+        result = self.app.get(url, {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc'})
+        root = lxml.etree.fromstring(result.body)
+
+        headers = root.xpath("//o:header", namespaces=self._namespaces)
+        self.assertEquals(len(headers), 4)
+        for header in headers:
+            identifier = header.xpath("string(o:identifier)", namespaces=self._namespaces)
+            set_spec = header.xpath("string(o:setSpec)", namespaces=self._namespaces)
+            self.assertEquals(set_spec, org_names[identifier])
+
+        for organization in organizations:
+            get_action('organization_delete')({'user': 'test_set_specs'}, {'id': organization['id']})
+
+    def test_record_table(self):
+        '''
+        Test that the record table gives the same records as rendering the datasets
+        '''
+        model.User(name="test_record_table", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_record_table'}, {'name': 'test-organization-record-table', 'title': "Test organization record table"})
+        packages = self._create_packages('test_record_table', organization, 3)
+        self.assertEquals(records.rebuild(), 3)
+        model.repo.commit()
+
+        rendered = list(CKANServer().listRecords(metadataPrefix='oai_dc', cursor=0, batch_size=10))
+        stored = list(records.RecordServer().listRecords(metadataPrefix='oai_dc', cursor=0, batch_size=10))
+        self.assertEquals([(header.identifier(), header.datestamp(), header.setSpec()) for header, metadata, about in rendered],
+                          [(header.identifier(), header.datestamp(), header.setSpec()) for header, metadata, about in stored])
+        for (_, rendered_metadata, _), (_, stored_metadata, _) in zip(rendered, stored):
+            self.assertEquals(rendered_metadata['title'], stored_metadata['title'])
+            self.assertEquals(rendered_metadata['identifier'], stored_metadata['identifier'])
+
+        rdf = records.RecordServer().getRecord(metadataPrefix='rdf', identifier=packages[0]['name'])[1]
+        lxml.etree.fromstring(rdf)
+
+        config['ckanext.oaipmh.record_table'] = 'true'
+        try:
+            get_action('package_delete')({'user': 'test_record_table'}, {'id': packages[0]['id']})
+        finally:
+            del config['ckanext.oaipmh.record_table']
+        stored = records.RecordServer().listIdentifiers(metadataPrefix='oai_dc', cursor=0, batch_size=10)
+        self.assertEquals(sorted((header.identifier(), header.isDeleted()) for header in stored),
+                          sorted([(packages[0]['id'], True)] + [(package['id'], False) for package in packages[1:]]))
+
+        # Bulk updates call no hooks, but the records follow them
+        config['ckanext.oaipmh.record_table'] = 'true'
+        try:
+            get_action('bulk_update_private')({'user': 'test_record_table'}, {'datasets': [packages[1]['id']],
+                                                                              'org_id': organization['id']})
+        finally:
+            del config['ckanext.oaipmh.record_table']
+        stored = records.RecordServer().listIdentifiers(metadataPrefix='oai_dc', cursor=0, batch_size=10)
+        self.assertEquals(sorted((header.identifier(), header.isDeleted()) for header in stored),
+                          sorted([(packages[0]['id'], True), (packages[1]['id'], True), (packages[2]['id'], False)]))
+        header, metadata, about = records.RecordServer().getRecord(metadataPrefix='oai_dc', identifier=packages[1]['id'])
+        self.assertTrue(header.isDeleted())
+        self.assertEquals(metadata, None)
+
+        get_action('organization_delete')({'user': 'test_record_table'}, {'id': organization['id']})
+
+    def test_deleted_records(self):
+        '''
+        Test that deleted and privatised datasets are listed as deleted records from their deletion time
+        '''
+        model.User(name="test_deleted", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_deleted'}, {'name': 'test-organization-deleted', 'title': "Test organization deleted"})
+        group = get_action('group_create')({'user': 'test_deleted'}, {'name': 'test-group-deleted', 'title': "Test group deleted"})
+        packages = self._create_packages('test_deleted', organization, 3)
+        get_action('member_create')({'user': 'test_deleted'}, {'id': group['id'], 'object': packages[0]['id'],
+                                                                'object_type': 'package', 'capacity': 'public'})
+
+        deleted_since = datetime.datetime.utcnow().replace(microsecond=0)
+        get_action('package_delete')({'user': 'test_deleted'}, {'id': packages[0]['id']})
+        private_package = get_action('package_show')({'user': 'test_deleted'}, {'id': packages[1]['id']})
+        private_package['private'] = True
+        get_action('package_update')({'user': 'test_deleted'}, private_package)
+
+        url = url_for('/oai')
+        result = self.app.get(url, {'verb': 'Identify'})
+        root = lxml.etree.fromstring(result.body)
+        self.assertEquals(self._get_single_result(root, "string(//o:deletedRecord)"), 'persistent')
+
+        for params in ({}, {'from': deleted_since.isoformat() + 'Z'}, {'set': organization['name']}):
+            params.update({'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'})
+            result = self.app.get(url, params)
+            root = lxml.etree.fromstring(result.body)
+            deleted = [header.xpath("string(o:identifier)", namespaces=self._namespaces)
+                       for header in root.xpath("//o:header[@status='deleted']", namespaces=self._namespaces)]
+            self.assertEquals(sorted(deleted), sorted([packages[0]['id'], packages[1]['id']]))
+            self.assertFalse(root.xpath("//o:header[@status='deleted']/../o:metadata", namespaces=self._namespaces))
+
+        result = self.app.get(url, {'verb': 'GetRecord', 'identifier': packages[0]['id'], 'metadataPrefix': 'oai_dc'})
+        root = lxml.etree.fromstring(result.body)
+        self.assertEquals(len(root.xpath("//o:header[@status='deleted']", namespaces=self._namespaces)), 1)
+
+        # Groups list their deleted datasets too
+        result = self.app.get(url, {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc', 'set': group['name']})
+        root = lxml.etree.fromstring(result.body)
+        self.assertEquals(root.xpath("//o:header[@status='deleted']/o:identifier/text()", namespaces=self._namespaces),
+                          [packages[0]['id']])
+
+        # Other types of packages get no records
+        harvest_source = model.Package(name='test-deleted-harvest-source', type='harvest')
+        model.Session.add(harvest_source)
+        model.repo.commit()
+        records.update_records([harvest_source.id])
+        records.tombstone_records([harvest_source.id])
+        record = oaipmh_model.oaipmh_record_table
+        self.assertEquals(model.Session.query(record).filter(record.c.id == harvest_source.id).count(), 0)
+
+        get_action('dataset_purge')({'user': 'test_deleted'}, {'id': packages[2]['id']})
+        for identifier in (packages[2]['id'], packages[2]['name']):
+            result = self.app.get(url, {'verb': 'GetRecord', 'identifier': identifier, 'metadataPrefix': 'oai_dc'})
+            root = lxml.etree.fromstring(result.body)
+            self.assertEquals(len(root.xpath("//o:header[@status='deleted']", namespaces=self._namespaces)), 1)
+        result = self.app.get(url, {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc', 'set': organization['name']})
+        root = lxml.etree.fromstring(result.body)
+        deleted = root.xpath("//o:header[@status='deleted']/o:identifier/text()", namespaces=self._namespaces)
+        self.assertEquals(sorted(deleted), sorted(package['id'] for package in packages))
+
+        get_action('group_delete')({'user': 'test_deleted'}, {'id': group['id']})
+        get_action('organization_delete')({'user': 'test_deleted'}, {'id': organization['id']})
+
+    def test_set_index(self):
+        '''
+        Test that the set member table follows the memberships of datasets and that ListSets counts the records of sets
+        '''
+        model.User(name="test_set_index", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_set_index'}, {'name': 'test-organization-set-index', 'title': "Test organization set index"})
+        group = get_action('group_create')({'user': 'test_set_index'}, {'name': 'test-group-set-index', 'title': "Test group set index"})
+        packages = self._create_packages('test_set_index', organization, 3)
+        get_action('member_create')({'user': 'test_set_index'}, {'id': group['id'], 'object': packages[0]['id'],
+                                                                  'object_type': 'package', 'capacity': 'public'})
+
+        def members(set_id):
+            member = oaipmh_model.oaipmh_set_member_table
+            return sorted(package_id for package_id, in model.Session.query(member.c.package_id).
+                          filter(member.c.set_id == set_id).filter(member.c.deleted == False))
+
+        self.assertEquals(members(organization['id']), sorted(package['id'] for package in packages))
+        self.assertEquals(members(group['id']), [packages[0]['id']])
+
+        private_package = get_action('package_show')({'user': 'test_set_index'}, {'id': packages[1]['id']})
+        private_package['private'] = True
+        get_action('package_update')({'user': 'test_set_index'}, private_package)
+        self.assertEquals(members(organization['id']), sorted([packages[0]['id'], packages[2]['id']]))
+
+        server = CKANServer()
+        self.assertEquals([set_spec for set_spec, name, description in server.listSets()],
+                          sorted([organization['name'], group['name']]))
+        # The privatised dataset is a deleted record of the organization
+        self.assertEquals(server.listSize('ListIdentifiers', set=organization['name']), 3)
+        self.assertEquals(server.listSize('ListIdentifiers', set=group['name']), 1)
+        self.assertEquals(server.listSize('ListSets'), 2)
+
+        # Lists of a set are paged by the datestamps of the set member table
+        records.rebuild()
+        for set_server in (server, records.RecordServer()):
+            first = set_server.listIdentifiers(metadataPrefix='oai_dc', set=organization['name'], cursor=0, batch_size=2)
+            last = first[-1]
+            rest = set_server.listIdentifiers(metadataPrefix='oai_dc', set=organization['name'], batch_size=2,
+                                              after=(last.datestamp(), last.identifier()))
+            self.assertEquals(sorted(header.identifier() for header in first + rest), sorted(package['id'] for package in packages))
+            self.assertEquals([header.isDeleted() for header in first + rest].count(True), 1)
+
+        # Bulk updates call no hooks, but the memberships follow them
+        get_action('bulk_update_private')({'user': 'test_set_index'}, {'datasets': [packages[2]['id']],
+                                                                        'org_id': organization['id']})
+        self.assertEquals(members(organization['id']), [packages[0]['id']])
+        self.assertEquals(sorted((header.identifier(), header.isDeleted()) for header in
+                                 server.listIdentifiers(metadataPrefix='oai_dc', set=organization['name'], cursor=0, batch_size=10)),
+                          sorted([(packages[0]['id'], False), (packages[1]['id'], True), (packages[2]['id'], True)]))
+
+        get_action('group_delete')({'user': 'test_set_index'}, {'id': group['id']})
+        self.assertEquals(members(group['id']), [])
+        self.assertEquals([set_spec for set_spec, name, description in server.listSets()], [organization['name']])
+
+        sets.rebuild()
+        self.assertEquals(members(organization['id']), [packages[0]['id']])
+
+        get_action('organization_delete')({'user': 'test_set_index'}, {'id': organization['id']})
+
+    def test_shard_sets(self):
+        '''
+        Test that shard sets are listed and cover each record exactly once, also with the record table
+        '''
+        model.User(name="test_shards", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_shards'}, {'name': 'test-organization-shards', 'title': "Test organization shards"})
+        packages = self._create_packages('test_shards', organization, 6)
+        get_action('package_delete')({'user': 'test_shards'}, {'id': packages[0]['id']})
+        ids = sorted(package['id'] for package in packages)
+        records.rebuild()
+
+        config['ckanext.oaipmh.shards'] = '3'
+        sets.configure(config)
+        try:
+            for server in (CKANServer(), records.RecordServer()):
+                set_specs = [set_spec for set_spec, name, description in server.listSets()]
+                self.assertEquals(set_specs, [organization['name'], 'shard:0-of-3', 'shard:1-of-3', 'shard:2-of-3'])
+
+                listed = []
+                for index in range(3):
+                    shard = [header.identifier() for header in
+                             server.listIdentifiers(metadataPrefix='oai_dc', set='shard:%d-of-3' % index, cursor=0, batch_size=10)]
+                    self.assertTrue(all(sets.shard_of(identifier, 3) == index for identifier in shard))
+                    self.assertEquals(server.listSize('ListIdentifiers', set='shard:%d-of-3' % index), len(shard))
+                    listed.extend(shard)
+                self.assertEquals(sorted(listed), ids)
+                self.assertEquals(sorted(header.identifier() for header in
+                                         server.listIdentifiers(metadataPrefix='oai_dc', set='shard:0-of-1', cursor=0, batch_size=10)), ids)
+                self.assertEquals(server.listIdentifiers(metadataPrefix='oai_dc', set='shard:3-of-3', cursor=0, batch_size=10), [])
+        finally:
+            del config['ckanext.oaipmh.shards']
+            sets.configure(config)
+
+        get_action('organization_delete')({'user': 'test_shards'}, {'id': organization['id']})
+
+    def test_urls(self):
+        '''
+        Test that the base URL and dataset URLs follow the routes and ckan.root_path
+        '''
+        site_url = config['ckan.site_url'].rstrip('/')
+        self.assertEquals(oaipmh_utils.get_oai_url(), site_url + url_for('/oai'))
+        self.assertEquals(oaipmh_utils.get_dataset_url('test-dataset'),
+                          site_url + url_for(controller='package', action='read', id='test-dataset'))
+
+        config['ckan.root_path'] = '/data/{{LANG}}'
+        try:
+            self.assertEquals(oaipmh_utils.get_oai_url(), site_url + '/data/oai')
+        finally:
+            del config['ckan.root_path']
+
+    def test_unknown_metadata_prefix(self):
+        '''
+        Test that streamed lists report unknown metadata prefixes as OAI-PMH errors
+        '''
+        model.User(name="test_unknown_prefix", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_unknown_prefix'}, {'name': 'test-organization-unknown-prefix', 'title': "Test organization unknown prefix"})
+        self._create_packages('test_unknown_prefix', organization, 1)
+
+        url = url_for('/oai')
+        for verb in ('ListRecords', 'ListIdentifiers'):
+            result = self.app.get(url, {'verb': verb, 'metadataPrefix': 'bogus'})
+            root = lxml.etree.fromstring(result.body)
+            self.assertEquals(self._get_single_result(root, "string(//o:error/@code)"), 'cannotDisseminateFormat')
+            self.assertFalse(root.xpath("//o:header", namespaces=self._namespaces))
+
+        get_action('organization_delete')({'user': 'test_unknown_prefix'}, {'id': organization['id']})
+
+    def test_list_from_until(self):
+        '''
+        Test that from and until select datasets by their datestamps and list each dataset once
+        '''
+        model.User(name="test_from_until", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_from_until'}, {'name': 'test-organization-from-until', 'title': "Test organization from until"})
+        package = self._create_packages('test_from_until', organization, 1)[0]
+        for i in range(2):
+            package = get_action('package_show')({'user': 'test_from_until'}, {'id': package['id']})
+            package['title'] = 'Updated title %d' % i
+            get_action('package_update')({'user': 'test_from_until'}, package)
+        modified = model.Package.get(package['id']).metadata_modified
+        second = modified.replace(microsecond=0)
+        hour = datetime.timedelta(hours=1)
+
+        def identifiers(**kw):
+            return [header.identifier() for header in
+                    CKANServer().listIdentifiers(metadataPrefix='oai_dc', cursor=0, batch_size=10, **kw)]
+
+        self.assertEquals(identifiers(from_=second - hour), [package['id']])
+        self.assertEquals(identifiers(from_=second - hour, until=second), [package['id']])
+        self.assertEquals(identifiers(from_=second, until=second), [package['id']])
+        self.assertEquals(identifiers(from_=second + datetime.timedelta(seconds=1)), [])
+        self.assertEquals(identifiers(until=second - datetime.timedelta(seconds=1)), [])
+        self.assertEquals(CKANServer().listSize('ListIdentifiers', from_=second - hour), 1)
+
+        get_action('organization_delete')({'user': 'test_from_until'}, {'id': organization['id']})
+
+    def test_parallel_rdf(self):
+        '''
+        Test that datasets serialized to RDF in parallel threads get the same records as serialized one at a time
+        '''
+        model.User(name="test_parallel_rdf", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_parallel_rdf'}, {'name': 'test-organization-parallel-rdf', 'title': "Test organization parallel rdf"})
+        packages = load_packages([package['id'] for package in self._create_packages('test_parallel_rdf', organization, 4)]).values()
+        expected = [CKANServer()._metadata_for_dataset_dcat(package) for package in packages]
+
+        results = {}
+
+        def render(thread):
+            results[thread] = [[CKANServer()._metadata_for_dataset_dcat(package) for package in packages]
+                               for i in range(5)]
+
+        threads = [threading.Thread(target=render, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        def graph(rdf):
+            return rdflib.Graph().parse(data=rdf, format='xml')
+
+        self.assertEquals(len(results), 8)
+        expected_graphs = [graph(rdf) for rdf in expected]
+        for rounds in results.values():
+            for result in rounds:
+                for rdf, expected_graph in zip(result, expected_graphs):
+                    self.assertTrue(isomorphic(graph(rdf), expected_graph))
+
+        get_action('organization_delete')({'user': 'test_parallel_rdf'}, {'id': organization['id']})
+
+    def test_render_threads(self):
+        '''
+        Test that records rendered by the render pool come in the order of the page
+        '''
+        model.User(name="test_render_threads", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_render_threads'}, {'name': 'test-organization-render-threads', 'title': "Test organization render threads"})
+        self._create_packages('test_render_threads', organization, 5)
+
+        def list_records():
+            record_cache.clear()
+            return [(header.identifier(), metadata['title']) for header, metadata, about in
+                    CKANServer().listRecords(metadataPrefix='oai_dc', cursor=0, batch_size=10)]
+
+        expected = list_records()
+        config['ckanext.oaipmh.render_threads'] = '3'
+        oaipmh_server.configure(config)
+        try:
+            self.assertEquals(oaipmh_server.render_threads, 3)
+            self.assertEquals(list_records(), expected)
+        finally:
+            del config['ckanext.oaipmh.render_threads']
+            oaipmh_server.configure(config)
+        self.assertEquals(len(expected), 5)
+
+        get_action('organization_delete')({'user': 'test_render_threads'}, {'id': organization['id']})
+
+    def test_conditional_request(self):
+        '''
+        Test that unchanged lists get 304 Not Modified and changed lists a new response
+        '''
+        model.User(name="test_conditional", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_conditional'}, {'name': 'test-organization-conditional', 'title': "Test organization conditional"})
+        package, older_package = self._create_packages('test_conditional', organization, 2)
+
+        url = url_for('/oai')
+        params = {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc'}
+        result = self.app.get(url, params)
+        etag = result.header('ETag')
+        last_modified = result.header('Last-Modified')
+
+        result = self.app.get(url, params, headers={'If-None-Match': etag}, status=304)
+        self.assertEquals(result.body, '')
+        self.app.get(url, params, headers={'If-Modified-Since': last_modified}, status=304)
+        self.app.get(url, dict(params, set=organization['name']), headers={'If-None-Match': etag}, status=200)
+
+        record_params = {'verb': 'GetRecord', 'metadataPrefix': 'oai_dc', 'identifier': older_package['id']}
+        record_etag = self.app.get(url, record_params).header('ETag')
+
+        package = get_action('package_show')({'user': 'test_conditional'}, {'id': package['id']})
+        package['title'] = 'Updated title'
+        get_action('package_update')({'user': 'test_conditional'}, package)
+        result = self.app.get(url, params, headers={'If-None-Match': etag}, status=200)
+        self.assertNotEquals(result.header('ETag'), etag)
+        # Records are validated by their own datestamps
+        self.app.get(url, record_params, headers={'If-None-Match': record_etag}, status=304)
+
+        # Bulk updates do not change the latest datestamp, but the change counter
+        etag = result.header('ETag')
+        get_action('bulk_update_private')({'user': 'test_conditional'}, {'datasets': [older_package['id']],
+                                                                          'org_id': organization['id']})
+        result = self.app.get(url, params, headers={'If-None-Match': etag}, status=200)
+        self.assertNotEquals(result.header('ETag'), etag)
+        self.app.get(url, record_params, headers={'If-None-Match': record_etag}, status=200)
+
+        get_action('organization_delete')({'user': 'test_conditional'}, {'id': organization['id']})
+
+    def test_compressed_response(self):
+        '''
+        Test that responses are compressed with the accepted content coding
+        '''
+        model.User(name="test_compressed", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_compressed'}, {'name': 'test-organization-compressed', 'title': "Test organization compressed"})
+        self._create_packages('test_compressed', organization, 2)
+
+        url = url_for('/oai')
+        params = {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'}
+        plain = self.app.get(url, params)
+        self.assertEquals(plain.header('Vary'), 'Accept-Encoding')
+
+        for encoding, wbits in (('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS)):
+            result = self.app.get(url, params, headers={'Accept-Encoding': encoding})
+            self.assertEquals(result.header('Content-Encoding'), encoding)
+            self.assertNotEquals(result.header('ETag'), plain.header('ETag'))
+            root = lxml.etree.fromstring(zlib.decompress(result.body, wbits))
+            self.assertEquals(len(root.xpath("//o:record", namespaces=self._namespaces)), 2)
+
+        result = self.app.get(url, {'verb': 'Identify'})
+        root = lxml.etree.fromstring(result.body)
+        self.assertEquals([compression.text for compression in root.xpath("//o:compression", namespaces=self._namespaces)],
+                          ['gzip', 'deflate'])
+
+        get_action('organization_delete')({'user': 'test_compressed'}, {'id': organization['id']})
+
+    def test_page_cache(self):
+        '''
+        Test that repeated requests are served from the page cache until a dataset changes
+        '''
+        model.User(name="test_page_cache", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_page_cache'}, {'name': 'test-organization-page-cache', 'title': "Test organization page cache"})
+        package = self._create_packages('test_page_cache', organization, 2)[0]
+
+        url = url_for('/oai')
+        params = {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'}
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        def get_page():
+            del statements[:]
+            result = self.app.get(url, params)
+            root = lxml.etree.fromstring(result.body)
+            return root.xpath("//dc:title/text()", namespaces=self._namespaces), len(statements)
+
+        event.listen(model.meta.engine, 'before_cursor_execute', count_statement)
+        try:
+            titles, rendered_count = get_page()
+            cached_titles, cached_count = get_page()
+
+            package = get_action('package_show')({'user': 'test_page_cache'}, {'id': package['id']})
+            package['title'] = 'Updated title'
+            get_action('package_update')({'user': 'test_page_cache'}, package)
+            updated_titles, updated_count = get_page()
+        finally:
+            event.remove(model.meta.engine, 'before_cursor_execute', count_statement)
+
+        self.assertEquals(cached_titles, titles)
+        self.assertTrue(cached_count < rendered_count)
+        self.assertTrue('Updated title' in updated_titles)
+        self.assertTrue(updated_count > cached_count)
+
+        # Membership changes do not change datestamps, but are counted
+        group = get_action('group_create')({'user': 'test_page_cache'}, {'name': 'test-group-page-cache', 'title': "Test group page cache"})
+        set_params = {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc', 'set': group['name']}
+        self.app.get(url, set_params)
+        get_action('member_create')({'user': 'test_page_cache'}, {'id': group['id'], 'object': package['id'],
+                                                                  'object_type': 'package', 'capacity': 'public'})
+        root = lxml.etree.fromstring(self.app.get(url, set_params).body)
+        self.assertEquals(root.xpath("//o:header/o:identifier/text()", namespaces=self._namespaces), [package['id']])
+
+        get_action('bulk_update_private')({'user': 'test_page_cache'}, {'datasets': [package['id']],
+                                                                         'org_id': organization['id']})
+        root = lxml.etree.fromstring(self.app.get(url, set_params).body)
+        self.assertEquals(root.xpath("//o:header[@status='deleted']/o:identifier/text()", namespaces=self._namespaces),
+                          [package['id']])
+
+        get_action('organization_delete')({'user': 'test_page_cache'}, {'id': organization['id']})
+
+    def test_snapshot(self):
+        '''
+        Test that complete harvests are served from a snapshot and incremental ones from the server
+        '''
+        model.User(name="test_snapshot", sysadmin=True).save()
+        organization = get_action('organization_create')({'user': 'test_snapshot'}, {'name': 'test-organization-snapshot', 'title': "Test organization snapshot"})
+        packages = self._create_packages('test_snapshot', organization, 3)
+
+        metadata_registry = oaimd.MetadataRegistry()
+        metadata_registry.registerWriter('oai_dc', oaisrv.oai_dc_writer)
+        server = StreamingBatchingServer(CKANServer(), metadata_registry=metadata_registry, resumption_batch_size=2)
+        directory = tempfile.mkdtemp()
+        config['ckanext.oaipmh.snapshot_dir'] = directory
+        try:
+            manifest = snapshot.write_snapshot(server, directory, ['oai_dc'])
+            self.assertEquals(manifest['pages'], {'oai_dc': 2})
+
+            updated = get_action('package_show')({'user': 'test_snapshot'}, {'id': packages[0]['id']})
+            updated['title'] = 'Updated after the snapshot'
+            get_action('package_update')({'user': 'test_snapshot'}, updated)
+
+            url = url_for('/oai')
+            params = {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'}
+            identifiers = []
+            while True:
+                result = self.app.get(url, params, headers={'Accept-Encoding': 'gzip'})
+                self.assertEquals(result.header('Content-Encoding'), 'gzip')
+                root = lxml.etree.fromstring(zlib.decompress(result.body, 16 + zlib.MAX_WBITS))
+                self.assertEquals(self._get_single_result(root, "string(//o:responseDate)"), manifest['datestamp'])
+                identifiers.extend(self._get_results(root, "//o:header/o:identifier/text()"))
+                token = self._get_single_result(root, "//o:resumptionToken").text
+                if not token:
+                    break
+                self.assertTrue(token.startswith('snapshot:'))
+                params = {'verb': 'ListRecords', 'resumptionToken': token}
+            self.assertEquals(sorted(identifiers), sorted(package['id'] for package in packages))
+
+            # Changes after the snapshot are harvested from the server
+            result = self.app.get(url, {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'from': manifest['datestamp']})
+            root = lxml.etree.fromstring(result.body)
+            self.assertTrue(packages[0]['id'] in self._get_results(root, "//o:header/o:identifier/text()"))
+            self.assertFalse(root.xpath("//o:resumptionToken[starts-with(text(), 'snapshot:')]", namespaces=self._namespaces))
+
+            shutil.rmtree(os.path.join(directory, manifest['id']))
+            result = self.app.get(url, params)
+            root = lxml.etree.fromstring(result.body)
+            self.assertEquals(self._get_single_result(root, "string(//o:error/@code)"), 'badResumptionToken')
+
+            # First pages of removed snapshots are made by the server
+            result = self.app.get(url, {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'})
+            root = lxml.etree.fromstring(result.body)
+            self.assertNotEquals(self._get_single_result(root, "string(//o:responseDate)"), manifest['datestamp'])
+            self.assertTrue(self._get_results(root, "//o:header/o:identifier/text()"))
+        finally:
+            del config['ckanext.oaipmh.snapshot_dir']
+            shutil.rmtree(directory)
+
+        get_action('organization_delete')({'user': 'test_snapshot'}, {'id': organization['id']})
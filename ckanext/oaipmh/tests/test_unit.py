@@ -5,6 +5,11 @@
 Unit tests for OAI-PMH harvester.
 """
 import copy
+import shutil
+import tempfile
+import threading
+import time
+import zlib
 from unittest import TestCase
 
 import testfixtures
@@ -15,15 +20,21 @@ from pylons import config
 import ckan
 from ckanext.harvest.commands import harvester
 from ckanext.harvest.model import HarvestJob, HarvestSource, HarvestObject
+from ckanext.oaipmh import model as oaipmh_model
+from ckanext.oaipmh.cache import ExpiringValue, LRUCache
+from ckanext.oaipmh.compression import choose_encoding, compress
 from ckanext.oaipmh.cmdi import CMDIHarvester
 from ckanext.oaipmh.cmdi_reader import CmdiReader
 from ckanext.oaipmh.harvester import OAIPMHHarvester
 import ckanext.harvest.model as harvest_model
 import ckanext.kata.model as kata_model
 from ckanext.oaipmh.ida import IdaHarvester
+from ckanext.oaipmh.sets import parse_shard, shard_of
+from ckanext.oaipmh.singleflight import SingleFlight
 from ckanext.oaipmh.importformats import create_metadata_registry
 import ckanext.oaipmh.oai_dc_reader as dcr
 from ckanext.oaipmh.oai_dc_reader import dc_metadata_reader
+from ckanext.oaipmh.rdftools import rdf_fragment
 import os
 from ckan import model
 from ckan.logic import get_action
@@ -100,6 +111,7 @@ class TestOAIPMHHarvester(TestCase):
         ckan.model.repo.rebuild_db()
         harvest_model.setup()
         kata_model.setup()
+        oaipmh_model.setup()
         cls.harvester = OAIPMHHarvester()
 
     def tearDown(self):
@@ -215,6 +227,7 @@ class TestIdaHarvester(TestCase):
         ''' Setup database and variables '''
         harvest_model.setup()
         kata_model.setup()
+        oaipmh_model.setup()
         cls.harvester = IdaHarvester()
 
     def tearDown(self):
@@ -241,6 +254,7 @@ class TestCMDIHarvester(TestCase):
         ''' Setup database and variables '''
         harvest_model.setup()
         kata_model.setup()
+        oaipmh_model.setup()
         cls.harvester = CMDIHarvester()
 
     def tearDown(self):
@@ -610,3 +624,164 @@ class TestImportFormats(TestCase):
 
         assert reg
         assert reg.hasReader('oai_dc')
+
+
+class TestRDFFragment(TestCase):
+    def test_rdf_fragment(self):
+        rdf = u'<?xml version="1.0" encoding="UTF-8"?>\n<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\u00e4</rdf:RDF>\n'
+        fragment = rdf_fragment(rdf)
+
+        assert fragment.startswith('<rdf:RDF')
+        assert isinstance(fragment, str)
+        assert etree.fromstring(fragment).text == u'\u00e4'
+
+
+class TestLRUCache(TestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        assert len(cache) == 2
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert cache.get('c') == 3
+
+    def test_spill(self):
+        spill_dir = tempfile.mkdtemp()
+        try:
+            cache = LRUCache(1, spill_dir)
+            cache.set(('id', 'oai_dc'), {'title': ['a']})
+            cache.set(('id', 'rdf'), '<rdf/>')
+
+            assert len(cache) == 1
+            assert cache.get(('id', 'oai_dc')) == {'title': ['a']}
+            assert cache.get(('id', 'rdf')) == '<rdf/>'
+            assert cache.get(('other', 'rdf')) is None
+        finally:
+            shutil.rmtree(spill_dir)
+
+    def test_configure(self):
+        spill_dir = os.path.join(tempfile.mkdtemp(), 'spill')
+        try:
+            cache = LRUCache(3)
+            for key in 'abc':
+                cache.set(key, key)
+            cache.configure(1, spill_dir)
+
+            assert os.path.isdir(spill_dir)
+            assert len(cache) == 1
+            assert cache.get('c') == 'c'
+        finally:
+            shutil.rmtree(os.path.dirname(spill_dir))
+
+
+class TestExpiringValue(TestCase):
+    def test_expiry(self):
+        values = iter(range(3))
+        value = ExpiringValue(60)
+
+        assert value.get(lambda: next(values)) == 0
+        assert value.get(lambda: next(values)) == 0
+        value.clear()
+        assert value.get(lambda: next(values)) == 1
+
+        expired = ExpiringValue(0)
+        assert expired.get(lambda: next(values)) == 2
+        assert expired.get(lambda: 3) == 3
+
+    def test_version(self):
+        values = iter(range(3))
+        value = ExpiringValue(60)
+
+        assert value.get(lambda: next(values), 1) == 0
+        assert value.get(lambda: next(values), 1) == 0
+        assert value.get(lambda: next(values), 2) == 1
+        assert value.get(lambda: next(values), 2) == 1
+
+
+class TestCompression(TestCase):
+    def test_choose_encoding(self):
+        assert choose_encoding('gzip, deflate') == 'gzip'
+        assert choose_encoding('deflate;q=1, gzip;q=0.5') == 'deflate'
+        assert choose_encoding('gzip;q=0, *') == 'deflate'
+        assert choose_encoding('identity') is None
+        assert choose_encoding(None) is None
+
+    def test_compress(self):
+        chunks = ['<a>', u'\u00e4' * 1000, '</a>']
+
+        assert zlib.decompress(''.join(compress(iter(chunks), 'gzip')), 16 + zlib.MAX_WBITS) == \
+            u''.join(chunks).encode('utf-8')
+        assert zlib.decompress(''.join(compress('<a/>', 'deflate'))) == '<a/>'
+
+
+class TestSingleFlight(TestCase):
+    def test_coalesced(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def make():
+            calls.append(1)
+            release.wait()
+            yield '<a>'
+            yield '</a>'
+
+        leader = flights.do('key', make)
+        followers = []
+
+        def follow():
+            followers.append(''.join(flights.do('key', lambda: ['<b/>'])))
+
+        threads = [threading.Thread(target=follow) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while flights.stats()['coalesced'] < 3:
+            time.sleep(0.01)
+        release.set()
+        body = ''.join(leader)
+        for thread in threads:
+            thread.join()
+
+        assert body == '<a></a>'
+        assert followers == ['<a></a>'] * 3
+        assert len(calls) == 1
+        assert flights.stats() == {'executed': 1, 'coalesced': 3, 'timed_out': 0, 'in_flight': 0}
+
+        assert ''.join(flights.do('key', lambda: '<b/>')) == '<b/>'
+        assert flights.executed == 2
+
+    def test_not_shared(self):
+        flights = SingleFlight()
+        leader = flights.do('key', lambda: iter(['1', '2', '3']))
+        assert next(leader) == '1'
+        # Nobody waited when the response started, so none of it is kept
+        assert ''.join(flights.do('key', lambda: ['x'])) == 'x'
+        assert ''.join(leader) == '23'
+        assert flights.stats() == {'executed': 2, 'coalesced': 0, 'timed_out': 0, 'in_flight': 0}
+
+    def test_timeout(self):
+        flights = SingleFlight(timeout=0.05)
+        flights.do('key', lambda: iter(['1']))
+        assert ''.join(flights.do('key', lambda: ['x'])) == 'x'
+        assert flights.stats() == {'executed': 1, 'coalesced': 1, 'timed_out': 1, 'in_flight': 0}
+        assert ''.join(flights.do('key', lambda: 'y')) == 'y'
+
+
+class TestShards(TestCase):
+    def test_parse_shard(self):
+        assert parse_shard('shard:0-of-8') == (0, 8)
+        assert parse_shard('shard:7-of-8') == (7, 8)
+        assert parse_shard('shard') is None
+        assert parse_shard('shard:8-of-8') is None
+        assert parse_shard('shard:0-of-0') is None
+        assert parse_shard('test-organization') is None
+        assert parse_shard(None) is None
+
+    def test_shard_of(self):
+        # First 32 bits of the MD5 hash, as in SQL
+        assert shard_of(u'abc', 2 ** 32) == 0x90015098
+        assert shard_of(u'abc', 8) == 0x90015098 % 8
@@ -1,4 +1,8 @@
+import re
+
 from iso639 import languages
+from pylons import config
+from sqlalchemy import func
 
 import ckan.model as model
 
@@ -26,5 +30,53 @@ def get_earliest_datestamp():
     http://www.openarchives.org/OAI/openarchivesprotocol.html#Identify
     '''
 
-    return model.Session.query(model.Package.metadata_modified).\
-        order_by(model.Package.metadata_modified).first()[0]
+    return model.Session.query(func.min(model.Package.metadata_modified)).scalar()
+
+
+_DATASET_NAME = 'oaipmh-dataset-name'
+
+# Paths of routes, made once with the routes mapper
+_paths = {}
+
+
+def _get_site_root():
+    '''
+    Return ckan.site_url followed by ckan.root_path for the default locale,
+    which url_for would put before the paths of routes.
+    '''
+
+    root = config.get('ckan.site_url', '').rstrip('/')
+    root_path = config.get('ckan.root_path')
+    if root_path:
+        root += re.sub('/{{LANG}}', '', root_path).rstrip('/')
+    return root
+
+
+def _get_path(name, **kwargs):
+    '''
+    Return the path of a route, generated with the routes mapper of CKAN on
+    the first call. Unlike url_for this works outside of a request, e.g.
+    while a streamed response is being generated.
+    '''
+
+    if name not in _paths:
+        _paths[name] = config['routes.map'].generate(_environ={}, **kwargs)
+    return _paths[name]
+
+
+def get_dataset_url(name):
+    '''
+    Return the URL of a dataset page.
+    '''
+
+    path = _get_path('dataset', controller='package', action='read', id=_DATASET_NAME)
+    return _get_site_root() + path.replace(_DATASET_NAME, name, 1)
+
+
+def get_oai_url():
+    '''
+    Return the base URL of the OAI-PMH interface, as mapped by the plugin.
+    '''
+
+    return _get_site_root() + _get_path('oai', controller='ckanext.oaipmh.controller:OAIPMHController',
+                                        action='index')
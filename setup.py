@@ -28,5 +28,8 @@ setup(
         ida_harvester=ckanext.oaipmh.ida:IdaHarvester
         cmdi_harvester=ckanext.oaipmh.cmdi:CMDIHarvester
         datacite_harvester=ckanext.oaipmh.datacite:DataCiteHarvester
+
+        [paste.paster_command]
+        oaipmh=ckanext.oaipmh.commands:OAIPMHCommand
         """,
 )